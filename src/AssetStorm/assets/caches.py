@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import caches
+from collections import OrderedDict
+from threading import Lock
+
+
+class GenerationCache:
+    """
+    Small in-process LRU cache whose entries are only valid for one WriteGeneration.
+    All entries of older generations are dropped as soon as a newer generation is seen.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.generation = None
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, generation: int, key):
+        with self.lock:
+            if generation != self.generation or key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, generation: int, key, value):
+        if self.max_size < 1:
+            return
+        with self.lock:
+            if self.generation is not None and generation < self.generation:
+                return
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation = None
+
+
+def asset_cache():
+    return caches["assets"]
+
+
+def asset_cache_key(asset_id):
+    return "content:%s" % str(asset_id)
+
+
+def stale_asset_cache_key(asset_id):
+    return "stale_content:%s" % str(asset_id)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+JSON codec used by all views. It uses orjson if it is installed and falls back to the json module
+of the standard library otherwise. dumps() always returns UTF-8 encoded bytes.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+JSONDecodeError = json.JSONDecodeError
+
+
+def stdlib_dumps(obj, sort_keys=False) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys).encode('utf-8')
+
+
+def stdlib_loads(data):
+    return json.loads(data)
+
+
+if orjson is not None:
+    name = "orjson"
+
+    def dumps(obj, sort_keys=False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0))
+
+    def loads(data):
+        return orjson.loads(data)
+else:  # pragma: no cover
+    name = "json"
+    dumps = stdlib_dumps
+    loads = stdlib_loads
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from AssetStorm.assets.models import Text, UriElement, Enum
+from difflib import SequenceMatcher
+import re
+
+
+def leaf_model(content_type):
+    if type(content_type) is list:
+        content_type = content_type[0]
+    if content_type == 1:
+        return Text
+    if content_type == 2:
+        return UriElement
+    if type(content_type) is dict and "3" in content_type:
+        return Enum
+    return None
+
+
+def leaf_value(leaf):
+    if leaf is None:
+        return None
+    if type(leaf) is Text:
+        return leaf.text
+    if type(leaf) is UriElement:
+        return leaf.uri
+    return leaf.item
+
+
+def text_diff(old_text: str, new_text: str):
+    """
+    Word-level diff of two texts as a list of operations with their character position in old_text.
+    """
+    old_tokens = re.findall(r"\s+|\S+", old_text)
+    new_tokens = re.findall(r"\s+|\S+", new_text)
+    positions = [0]
+    for token in old_tokens:
+        positions.append(positions[-1] + len(token))
+    return [{
+        "op": tag,
+        "position": positions[i1],
+        "from": "".join(old_tokens[i1:i2]),
+        "to": "".join(new_tokens[j1:j2])
+    } for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_tokens, new_tokens, autojunk=False).get_opcodes()
+        if tag != "equal"]
+
+
+def structure_operations(schema: dict, from_structure: dict, to_structure: dict):
+    """
+    Compares two structures key by key using only the ids. Every difference becomes an operation with the
+    key, the kind of change, the position in the list and the replaced and inserted ids.
+    """
+    operations = []
+    for key, content_type in schema.items():
+        old_ids = from_structure.get(key)
+        new_ids = to_structure.get(key)
+        if type(content_type) is not list:
+            old_ids = [] if old_ids is None else [old_ids]
+            new_ids = [] if new_ids is None else [new_ids]
+        old_ids = old_ids or []
+        new_ids = new_ids or []
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, [str(pk) for pk in old_ids], [str(pk) for pk in new_ids],
+                                                   autojunk=False).get_opcodes():
+            if tag != "equal":
+                operations.append({
+                    "key": key,
+                    "op": tag,
+                    "position": i1,
+                    "from": old_ids[i1:i2],
+                    "to": new_ids[j1:j2]
+                })
+    return operations
+
+
+def add_leaf_values(schema: dict, operations: list):
+    """
+    Adds the values of the changed Text, UriElement and Enum leaves to the operations with one query per
+    model, and a text diff for every pair of replaced and inserted Text.
+    """
+    leaf_ids = {Text: set(), UriElement: set(), Enum: set()}
+    for operation in operations:
+        model = leaf_model(schema[operation["key"]])
+        if model is not None:
+            leaf_ids[model].update(int(pk) for pk in operation["from"] + operation["to"])
+    leaves = {model: model.objects.in_bulk(ids) for model, ids in leaf_ids.items() if len(ids) > 0}
+    for operation in operations:
+        model = leaf_model(schema[operation["key"]])
+        if model is None:
+            continue
+        operation["from_values"] = [leaf_value(leaves[model].get(int(pk))) for pk in operation["from"]]
+        operation["to_values"] = [leaf_value(leaves[model].get(int(pk))) for pk in operation["to"]]
+        if model is Text and operation["op"] == "replace":
+            operation["text_diffs"] = [text_diff(old_text or "", new_text or "") for old_text, new_text in zip(
+                operation["from_values"], operation["to_values"])]
+    return operations
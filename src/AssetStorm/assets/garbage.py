@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from django.db import connection, transaction
+from django.utils import timezone
+from AssetStorm.assets.models import Asset, AssetChange, AssetType, Text, UriElement, Enum, GarbageMark
+from datetime import timedelta
+
+KINDS = {
+    "asset": (Asset, "uuid", "asset_reference_list",
+              "jsonb_typeof(inserted.element_type) = 'number' AND inserted.element_type NOT IN ('1', '2')"),
+    "text": (Text, "int", "text_reference_list", "inserted.element_type = '1'"),
+    "uri": (UriElement, "int", "uri_reference_list", "inserted.element_type = '2'"),
+    "enum": (Enum, "int", "enum_reference_list", "jsonb_typeof(inserted.element_type) = 'object'")
+}
+
+
+def referenced_ids_sql(kind: str):
+    """
+    SQL which selects the ids of all objects of a kind that are referenced by any AssetChange (current or
+    historical), by the reference lists of any asset or, for assets, as a previous revision.
+    """
+    model, id_type, reference_list, element_condition = KINDS[kind]
+    sql = "SELECT (inserted.value #>> '{{}}')::{id_type} FROM (" \
+          "SELECT CASE WHEN jsonb_typeof(asset_type.schema -> change.key) = 'array' " \
+          "THEN asset_type.schema -> change.key -> 0 ELSE asset_type.schema -> change.key END AS element_type, " \
+          "element.value FROM {change_table} change " \
+          "JOIN {asset_table} asset ON asset.id = change.asset_id " \
+          "JOIN {type_table} asset_type ON asset_type.id = asset.t_id " \
+          "CROSS JOIN LATERAL jsonb_array_elements(CASE WHEN jsonb_typeof(change.inserts) = 'array' " \
+          "THEN change.inserts ELSE jsonb_build_array(change.inserts) END) AS element(value)) AS inserted " \
+          "WHERE jsonb_typeof(inserted.value) IN ('number', 'string') AND {element_condition} " \
+          "UNION SELECT unnest({reference_list}) FROM {asset_table}".format(
+              id_type=id_type,
+              change_table=AssetChange._meta.db_table,
+              asset_table=Asset._meta.db_table,
+              type_table=AssetType._meta.db_table,
+              element_condition=element_condition,
+              reference_list=reference_list)
+    if kind == "asset":
+        sql += " UNION SELECT revision_chain_id FROM {asset_table} WHERE revision_chain_id IS NOT NULL " \
+               "UNION SELECT asset_id FROM {change_table}".format(
+                   asset_table=Asset._meta.db_table,
+                   change_table=AssetChange._meta.db_table)
+    return sql
+
+
+def materialize_referenced_ids(kind: str) -> str:
+    """
+    Evaluates referenced_ids_sql once and stores the ids in an indexed temporary table whose name is returned.
+    mark and sweep check every batch with primary key lookups against this table instead of re-evaluating the
+    whole reference scan per batch. References which are committed after the table was filled are not seen,
+    which is why the collect_garbage command refreshes it at the start of every run.
+    """
+    table = "garbage_referenced_%s" % kind
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {table}".format(table=table))
+        cursor.execute("CREATE TEMPORARY TABLE {table} (id {id_type} PRIMARY KEY)".format(
+            table=table, id_type=KINDS[kind][1]))
+        cursor.execute("INSERT INTO {table} SELECT referenced.id FROM ({referenced}) AS referenced(id) "
+                       "WHERE referenced.id IS NOT NULL".format(table=table, referenced=referenced_ids_sql(kind)))
+        cursor.execute("ANALYZE {table}".format(table=table))
+    return table
+
+
+def drop_referenced_ids(table: str):
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {table}".format(table=table))
+
+
+def mark(kind: str, batch_size: int, referenced_table: str) -> int:
+    """
+    Marks the unreferenced objects of a kind. The table is walked in pk order in batches of batch_size and
+    every batch is checked against referenced_table (see materialize_referenced_ids) and marked with one
+    short statement. Assets count as referenced while they have changes, so only assets without content
+    which nothing points to get marked. Revision copies keep their snapshot change and are never marked.
+    """
+    model, id_type = KINDS[kind][:2]
+    marked_count = 0
+    last_id = None
+    while True:
+        candidates = model.objects.order_by("pk")
+        if last_id is not None:
+            candidates = candidates.filter(pk__gt=last_id)
+        object_ids = list(candidates.values_list("pk", flat=True)[:batch_size])
+        if len(object_ids) < 1:
+            return marked_count
+        last_id = object_ids[-1]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {mark_table} (kind, object_id, marked) "
+                "SELECT %s, candidate.id::text, %s FROM unnest(%s::{id_type}[]) AS candidate(id) "
+                "WHERE NOT EXISTS (SELECT 1 FROM {referenced_table} referenced WHERE referenced.id = candidate.id) "
+                "ON CONFLICT (kind, object_id) DO NOTHING".format(
+                    mark_table=GarbageMark._meta.db_table,
+                    id_type=id_type,
+                    referenced_table=referenced_table),
+                [kind, timezone.now(), [str(object_id) for object_id in object_ids]])
+            marked_count += cursor.rowcount
+
+
+def sweep(kind: str, grace: float, batch_size: int, referenced_table: str) -> int:
+    """
+    Deletes the objects of a kind which were marked more than grace seconds ago and are still missing from
+    referenced_table, one transaction per batch of marks. Objects which got referenced again only lose their
+    mark. referenced_table has to be filled after the marks are old enough, so sweep always needs a fresh one.
+    """
+    model, id_type = KINDS[kind][:2]
+    deleted_count = 0
+    while True:
+        with transaction.atomic():
+            marks = list(GarbageMark.objects.select_for_update(skip_locked=True).filter(
+                kind=kind, marked__lt=timezone.now() - timedelta(seconds=grace)).order_by("pk")[:batch_size])
+            if len(marks) < 1:
+                return deleted_count
+            object_ids = [mark.object_id for mark in marks]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT referenced.id::text FROM {referenced_table} referenced "
+                    "WHERE referenced.id = ANY(%s::{id_type}[])".format(
+                        referenced_table=referenced_table, id_type=id_type),
+                    [object_ids])
+                referenced_ids = set(row[0] for row in cursor.fetchall())
+            garbage_ids = [object_id for object_id in object_ids if object_id not in referenced_ids]
+            if len(garbage_ids) > 0:
+                model.objects.filter(pk__in=garbage_ids).delete()
+                deleted_count += len(garbage_ids)
+            GarbageMark.objects.filter(pk__in=[mark.pk for mark in marks]).delete()
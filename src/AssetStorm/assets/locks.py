@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db import connection
+from contextlib import contextmanager
+from hashlib import blake2b
+import time
+
+
+def lock_id(*parts) -> int:
+    """
+    Maps the parts (e.g. a cache name and an asset id) to a signed 64 bit key for Postgres advisory locks.
+    """
+    digest = blake2b(":".join(str(part) for part in parts).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, byteorder='big', signed=True)
+
+
+def try_advisory_lock(key: int) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [key])
+        return cursor.fetchone()[0]
+
+
+def advisory_unlock(key: int):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+
+def try_advisory_locks(keys: list) -> list:
+    """
+    Tries to take the advisory locks for all keys with one query. Returns whether each one was acquired.
+    """
+    if len(keys) < 1:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(key) FROM unnest(%s::bigint[]) WITH ORDINALITY AS k(key, i) "
+                       "ORDER BY i", [keys])
+        return [acquired for acquired, in cursor.fetchall()]
+
+
+def advisory_unlock_many(keys: list):
+    if len(keys) < 1:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(key) FROM unnest(%s::bigint[]) AS k(key)", [keys])
+
+
+class Flight:
+    def __init__(self, acquired: bool, waited: bool):
+        self.acquired = acquired
+        self.waited = waited
+
+
+@contextmanager
+def single_flight(key: int, wait: float = None):
+    """
+    Makes sure only one process at a time rebuilds the cache behind key. If another process holds the
+    lock this waits up to wait seconds (default: settings.STAMPEDE_WAIT) for it to finish.
+    The yielded Flight tells whether the lock was acquired and whether it was necessary to wait. After
+    waiting callers should re-read the cache because the other process has probably filled it.
+    """
+    if wait is None:
+        wait = settings.STAMPEDE_WAIT
+    deadline = time.monotonic() + wait
+    acquired = try_advisory_lock(key)
+    waited = not acquired
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(0.05)
+        acquired = try_advisory_lock(key)
+    try:
+        yield Flight(acquired, waited)
+    finally:
+        if acquired:
+            advisory_unlock(key)
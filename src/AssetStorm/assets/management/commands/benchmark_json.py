@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from AssetStorm.assets import codec
+from timeit import timeit
+import yaml
+import os
+
+
+class Command(BaseCommand):
+    help = "Compare the JSON codec used by the views with the json module of the standard library " + \
+           "on the fixture documents"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=200,
+                            help="Number of encode and decode runs per document and codec")
+
+    def handle(self, *args, **options):
+        asset_dir = os.path.join(settings.BASE_DIR, "AssetStorm", "assets")
+        documents = {}
+        fixture_dir = os.path.join(asset_dir, "fixtures")
+        for file_name in sorted(os.listdir(fixture_dir)):
+            with open(os.path.join(fixture_dir, file_name), 'r') as fixture_file:
+                documents[file_name] = yaml.safe_load(fixture_file.read())
+        with open(os.path.join(asset_dir, "tests", "testilinio.json"), 'rb') as testilinio_file:
+            documents["testilinio.json"] = codec.loads(testilinio_file.read())
+        print("Active codec: %s" % codec.name)
+        print("%-28s %8s %12s %12s %12s %12s" % (
+            "document", "bytes", "json dumps", codec.name + " dumps", "json loads", codec.name + " loads"))
+        for document_name, document in documents.items():
+            encoded = codec.stdlib_dumps(document)
+            print("%-28s %8d %10.3fms %10.3fms %10.3fms %10.3fms" % (
+                document_name,
+                len(encoded),
+                1000 * timeit(lambda: codec.stdlib_dumps(document), number=options["repeat"]) / options["repeat"],
+                1000 * timeit(lambda: codec.dumps(document), number=options["repeat"]) / options["repeat"],
+                1000 * timeit(lambda: codec.stdlib_loads(encoded), number=options["repeat"]) / options["repeat"],
+                1000 * timeit(lambda: codec.loads(encoded), number=options["repeat"]) / options["repeat"]))
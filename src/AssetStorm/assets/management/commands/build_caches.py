@@ -1,15 +1,197 @@
 # -*- coding: utf-8 -*-
-from django.core.management.base import BaseCommand
-from AssetStorm.assets.views import update_caches
-import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime, parse_date
+from AssetStorm.assets.models import Asset, AssetChange, CacheBuildCheckpoint
+from AssetStorm.assets.views import warm_up_caches, rebuild_caches, prerender_templates
+from AssetStorm.assets.views import missing_or_outdated_content_caches, missing_or_outdated_raw_caches
+from datetime import datetime, time as day_start
+import multiprocessing
+import time
+import uuid
+
+CHUNKS_PER_WORKER = 4
+
+
+def uuid_ranges(count: int) -> list:
+    """
+    Splits the UUID space into count ranges of equal size. The last range has no upper bound.
+    """
+    step = 2 ** 128 // count
+    bounds = [uuid.UUID(int=i * step) for i in range(count)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def missing_or_outdated_ids(asset_ids: list) -> list:
+    """
+    Returns the ids of the given assets whose content or raw cache is missing or outdated, in id order.
+    Only the recorded versions of these assets are checked.
+    """
+    return list(Asset.objects.filter(
+        missing_or_outdated_content_caches(asset_ids) | missing_or_outdated_raw_caches(asset_ids)).order_by(
+        "pk").values_list("pk", flat=True))
+
+
+def rebuild_caches_in_range(id_range: tuple, asset_filter: Q = Q(), batch_size: int = 1000) -> dict:
+    """
+    Pages through the assets in the id range in id order and rebuilds the missing or outdated caches of
+    every page, like rebuild_in_batches does.
+    """
+    low, high = id_range
+    assets = Asset.objects.filter(asset_filter).filter(pk__gte=low)
+    if high is not None:
+        assets = assets.filter(pk__lt=high)
+    statistics = {
+        'rebuilt_content_caches': 0,
+        'rendered_raw_templates': 0
+    }
+    last_asset_id = None
+    while True:
+        page = assets if last_asset_id is None else assets.filter(pk__gt=last_asset_id)
+        page_ids = list(page.order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if len(page_ids) < 1:
+            break
+        last_asset_id = page_ids[-1]
+        batch_ids = missing_or_outdated_ids(page_ids)
+        if len(batch_ids) > 0:
+            batch_statistics = rebuild_caches(asset_ids=batch_ids)
+            for key in statistics.keys():
+                statistics[key] += batch_statistics[key]
+    connections.close_all()
+    return statistics
+
+
+def parallel_rebuild_caches(workers: int, asset_filter: Q = Q(), batch_size: int = 1000) -> dict:
+    """
+    Rebuilds the caches in id-range chunks with a pool of worker processes. Every process opens its own
+    database connection. Concurrent rebuilds of shared sub-assets are serialized by the advisory locks
+    in Asset.load_contents and Asset.render_template.
+    """
+    connections.close_all()
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        chunk_statistics = pool.starmap(rebuild_caches_in_range, [
+            (id_range, asset_filter, batch_size) for id_range in uuid_ranges(workers * CHUNKS_PER_WORKER)])
+    return {key: sum(statistics[key] for statistics in chunk_statistics) for key in chunk_statistics[0].keys()}
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
 
 
 class Command(BaseCommand):
     help = "Build the content and raw_template cache for all Asset which do not have one"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--warm-up", action="store_true",
+                            help="Only rebuild the caches of the most accessed assets first " +
+                                 "and fill the shared asset cache with them")
+        parser.add_argument("--time-budget", type=float, default=None,
+                            help="Stop the warm-up after this many seconds")
+        parser.add_argument("--count-budget", type=int, default=None,
+                            help="Stop the warm-up after this many assets")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of processes which rebuild the caches in parallel")
+        parser.add_argument("--type", default=None,
+                            help="Only build the caches of assets with this type_name or a child type of it")
+        parser.add_argument("--changed-since", default=None,
+                            help="Only build the caches of assets changed at or after this date or datetime")
+        parser.add_argument("--limit", type=int, default=None,
+                            help="Stop after this many assets")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Number of assets which are checked and rebuilt in one batch")
+        parser.add_argument("--resume", action="store_true",
+                            help="Continue after the last checkpoint of an interrupted run with the same filters")
+        parser.add_argument("--templates", nargs="+", default=[],
+                            help="Also render these template keys (like markdown proof_html) into the template cache")
+        parser.add_argument("--all-templates", action="store_true",
+                            help="Also render all template keys of every type into the template cache")
+
+    def get_asset_filter(self, options) -> Q:
+        asset_filter = Q()
+        if options["type"] is not None:
+            asset_filter &= Q(t__type_name=options["type"]) | Q(t__parent_type__type_name=options["type"])
+        if options["changed_since"] is not None:
+            changed_since = parse_datetime(options["changed_since"])
+            if changed_since is None and parse_date(options["changed_since"]) is not None:
+                changed_since = datetime.combine(parse_date(options["changed_since"]), day_start.min)
+            if changed_since is None:
+                raise CommandError("--changed-since must be a date or datetime like 2020-04-01 or 2020-04-01T12:00")
+            asset_filter &= Q(pk__in=AssetChange.objects.filter(time__gte=changed_since).values("asset_id"))
+        return asset_filter
+
     def handle(self, *args, **options):
-        response = update_caches()
-        print("rebuilt_content_caches:",
-              json.loads(str(response.content, encoding="utf-8"))['rebuilt_content_caches'])
-        print("rendered_raw_templates:",
-              json.loads(str(response.content, encoding="utf-8"))['rendered_raw_templates'])
+        if options["warm_up"]:
+            statistics = warm_up_caches(time_budget=options["time_budget"], count_budget=options["count_budget"])
+            print("warmed_up_assets:", statistics['warmed_up_assets'])
+            print("rebuilt_content_caches:", statistics['rebuilt_content_caches'])
+            print("rendered_raw_templates:", statistics['rendered_raw_templates'])
+            return
+        asset_filter = self.get_asset_filter(options)
+        if options["workers"] > 1:
+            if options["resume"] or options["limit"] is not None:
+                raise CommandError("--resume and --limit can not be combined with --workers.")
+            statistics = parallel_rebuild_caches(options["workers"], asset_filter, options["batch_size"])
+        else:
+            statistics = self.rebuild_in_batches(asset_filter, options)
+        print("rebuilt_content_caches:", statistics['rebuilt_content_caches'])
+        print("rendered_raw_templates:", statistics['rendered_raw_templates'])
+        if options["all_templates"] or len(options["templates"]) > 0:
+            statistics = prerender_templates(None if options["all_templates"] else options["templates"],
+                                             asset_filter)
+            print("prerendered_templates:", statistics['prerendered_templates'])
+
+    def rebuild_in_batches(self, asset_filter: Q, options) -> dict:
+        """
+        Pages through the assets matching the filter in id order and rebuilds the missing or outdated caches
+        of every page. Staleness is only checked for the ids of the current page, so every batch costs the
+        same no matter how large the archive is. The last finished id is stored as a checkpoint after every
+        page. The checkpoint is removed when the run completes.
+        """
+        checkpoint_key = "build_caches type=%s changed_since=%s" % (options["type"], options["changed_since"])
+        assets = Asset.objects.filter(asset_filter)
+        last_asset_id = None
+        if options["resume"]:
+            checkpoint = CacheBuildCheckpoint.objects.filter(key=checkpoint_key).first()
+            if checkpoint is not None:
+                last_asset_id = checkpoint.last_asset_id
+                print("Resuming after asset %s." % str(last_asset_id))
+        total = (assets if last_asset_id is None else assets.filter(pk__gt=last_asset_id)).count()
+        statistics = {
+            'rebuilt_content_caches': 0,
+            'rendered_raw_templates': 0
+        }
+        checked = 0
+        rebuilt = 0
+        limit_reached = False
+        started = time.monotonic()
+        while True:
+            if options["limit"] is not None and rebuilt >= options["limit"]:
+                limit_reached = True
+                break
+            page = assets if last_asset_id is None else assets.filter(pk__gt=last_asset_id)
+            page_ids = list(page.order_by("pk").values_list("pk", flat=True)[:options["batch_size"]])
+            if len(page_ids) < 1:
+                break
+            batch_ids = missing_or_outdated_ids(page_ids)
+            if options["limit"] is not None and rebuilt + len(batch_ids) > options["limit"]:
+                batch_ids = batch_ids[:options["limit"] - rebuilt]
+                page_ids = [pk for pk in page_ids if pk <= batch_ids[-1]]
+            if len(batch_ids) > 0:
+                batch_statistics = rebuild_caches(asset_ids=batch_ids)
+                for key in statistics.keys():
+                    statistics[key] += batch_statistics[key]
+            rebuilt += len(batch_ids)
+            checked += len(page_ids)
+            last_asset_id = page_ids[-1]
+            CacheBuildCheckpoint.objects.update_or_create(key=checkpoint_key,
+                                                          defaults={"last_asset_id": last_asset_id})
+            elapsed = time.monotonic() - started
+            throughput = checked / elapsed if elapsed > 0 else 0
+            print("%d/%d assets checked, %d rebuilt (%.1f assets/s, ETA %s)" % (
+                checked, total, rebuilt, throughput,
+                format_duration((total - checked) / throughput) if throughput > 0 else "?"))
+        if not limit_reached:
+            CacheBuildCheckpoint.objects.filter(key=checkpoint_key).delete()
+        return statistics
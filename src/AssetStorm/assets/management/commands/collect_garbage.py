@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from AssetStorm.assets.garbage import KINDS, materialize_referenced_ids, drop_referenced_ids, mark, sweep
+
+
+class Command(BaseCommand):
+    help = "Delete Texts, UriElements, Enums and Assets which were unreferenced since the last run and mark " + \
+           "the currently unreferenced ones for the next run. Every asset with changes counts as a root because " + \
+           "any asset can be a top-level document. Revision copies keep a snapshot change, so they are kept as " + \
+           "well and only assets without content which nothing points to are collected."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=float, default=3600,
+                            help="Seconds a marked object has to stay unreferenced before it gets deleted")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Number of objects which are checked and marked or deleted in one statement")
+
+    def handle(self, *args, **options):
+        referenced_tables = {kind: materialize_referenced_ids(kind) for kind in KINDS.keys()}
+        try:
+            for kind in KINDS.keys():
+                print("deleted_%s:" % kind, sweep(kind, options["grace"], options["batch_size"],
+                                                   referenced_tables[kind]))
+            for kind in KINDS.keys():
+                print("marked_%s:" % kind, mark(kind, options["batch_size"], referenced_tables[kind]))
+        finally:
+            for table in referenced_tables.values():
+                drop_referenced_ids(table)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from AssetStorm.assets.models import AssetChange, StructureError
+from datetime import timedelta
+
+
+class Command(BaseCommand):
+    help = "Squash the AssetChanges older than the retention horizon into one base change per asset"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=float, default=90,
+                            help="Retention horizon in days. Newer changes are kept as they are.")
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Number of assets which are compacted in one transaction")
+
+    def handle(self, *args, **options):
+        horizon = timezone.now() - timedelta(days=options["older_than"])
+        candidates = AssetChange.objects.filter(time__lt=horizon).values("asset_id").annotate(
+            old_changes=Count("pk")).filter(old_changes__gte=2).order_by("asset_id")
+        statistics = {
+            'compacted_assets': 0,
+            'squashed_changes': 0,
+            'dropped_structure_caches': 0
+        }
+        last_asset_id = None
+        while True:
+            batch = candidates if last_asset_id is None else candidates.filter(asset_id__gt=last_asset_id)
+            asset_ids = list(batch.values_list("asset_id", flat=True)[:options["batch_size"]])
+            if len(asset_ids) < 1:
+                break
+            try:
+                with transaction.atomic():
+                    for asset_id in asset_ids:
+                        asset_statistics = AssetChange.compact(asset_id, horizon)
+                        statistics['squashed_changes'] += asset_statistics['squashed_changes']
+                        statistics['dropped_structure_caches'] += asset_statistics['dropped_structure_caches']
+            except StructureError as error:
+                raise CommandError(str(error) + " The batch was rolled back.")
+            statistics['compacted_assets'] += len(asset_ids)
+            last_asset_id = asset_ids[-1]
+        print("compacted_assets:", statistics['compacted_assets'])
+        print("squashed_changes:", statistics['squashed_changes'])
+        print("dropped_structure_caches:", statistics['dropped_structure_caches'])
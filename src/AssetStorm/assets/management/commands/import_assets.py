@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.postgres.fields import ArrayField
+from django.db import connection, models, transaction
+from django.utils import timezone
+from AssetStorm.assets.models import Text, UriElement, Enum, Asset, AssetChange, WriteGeneration
+from AssetStorm.assets.views import AssetStructureError, SchemaTypes, check_asset
+from AssetStorm.assets import codec
+from datetime import timedelta
+from io import StringIO
+import sys
+import time
+
+COPY_MODELS = [Text, UriElement, Enum, Asset, AssetChange]
+LEAF_MODELS = [Text, UriElement, Enum]
+
+
+def copy_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+
+
+def copy_value(field, value) -> str:
+    """
+    Formats a field value for the text format of COPY.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(field, models.JSONField):
+        return copy_escape(codec.dumps(value).decode('utf-8'))
+    if isinstance(field, ArrayField):
+        return "{" + ",".join(str(item) for item in value) + "}"
+    if isinstance(field, models.BooleanField):
+        return "t" if value else "f"
+    if isinstance(field, models.DateTimeField):
+        return value.isoformat()
+    if isinstance(field, models.BinaryField):
+        return copy_escape("\\x" + bytes(value).hex())
+    return copy_escape(str(value))
+
+
+def copy_objects(cursor, model, objects: list):
+    """
+    Writes unsaved model instances with a single COPY. The primary keys have to be set already.
+    """
+    fields = model._meta.concrete_fields
+    buffer = StringIO()
+    for obj in objects:
+        buffer.write("\t".join(copy_value(field, getattr(obj, field.attname)) for field in fields) + "\n")
+    buffer.seek(0)
+    cursor.copy_expert("COPY %s (%s) FROM STDIN" % (
+        connection.ops.quote_name(model._meta.db_table),
+        ", ".join(connection.ops.quote_name(field.column) for field in fields)), buffer)
+
+
+def reserve_ids(cursor, model, objects: list):
+    if len(objects) < 1:
+        return
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                   [model._meta.db_table, model._meta.pk.column, len(objects)])
+    for obj, (pk,) in zip(objects, cursor.fetchall()):
+        obj.pk = pk
+
+
+def insert_value(item):
+    if isinstance(item, Asset):
+        return str(item.pk)
+    if isinstance(item, str):
+        return item
+    return item.pk
+
+
+class AssetBatch:
+    """
+    Collects the rows of many asset trees, so they can be loaded with one COPY per table.
+    """
+    def __init__(self, schema_types: SchemaTypes):
+        self.schema_types = schema_types
+        self.objects = {model: [] for model in COPY_MODELS}
+        self.contents = []
+        self.trees = 0
+
+    def add(self, tree, item_type=None):
+        if item_type == 1:
+            self.objects[Text].append(Text(text=tree))
+            return self.objects[Text][-1]
+        if item_type == 2:
+            self.objects[UriElement].append(UriElement(uri=tree))
+            return self.objects[UriElement][-1]
+        if type(item_type) is dict and \
+                len(item_type.keys()) == 1 and \
+                "3" in item_type.keys():
+            self.objects[Enum].append(Enum(t_id=item_type["3"], item=tree))
+            return self.objects[Enum][-1]
+        if "id" in tree.keys():
+            if len(tree.keys()) > 1:
+                raise AssetStructureError(
+                    tree,
+                    "The import only creates new Assets. Existing Assets may only be referenced by their id.")
+            return tree["id"]
+        asset_type = self.schema_types.asset_type(tree["type"])
+        content = {}
+        for key in asset_type.schema.keys():
+            if type(asset_type.schema[key]) is list:
+                content[key] = [self.add(list_item, item_type=asset_type.schema[key][0])
+                                for list_item in tree[key]]
+            else:
+                content[key] = self.add(tree[key], item_type=asset_type.schema[key])
+        asset = Asset(t=asset_type)
+        self.objects[Asset].append(asset)
+        self.contents.append((asset, content))
+        return asset
+
+    def add_tree(self, tree):
+        """
+        Adds all rows of a tree or none of them, so a tree which is rejected halfway leaves no orphans behind.
+        """
+        object_counts = {model: len(objects) for model, objects in self.objects.items()}
+        content_count = len(self.contents)
+        try:
+            self.add(tree)
+        except AssetStructureError:
+            for model, objects in self.objects.items():
+                del objects[object_counts[model]:]
+            del self.contents[content_count:]
+            raise
+        self.trees += 1
+
+    def build_changes(self):
+        """
+        Creates the change chain of every asset. Only the head change gets a structure_cache because
+        the structure of an asset is only read from its newest change.
+        """
+        base_time = timezone.now()
+        for asset, content in self.contents:
+            parent = None
+            structure = {}
+            for i, (key, items) in enumerate(content.items()):
+                inserts = [insert_value(item) for item in items] if type(items) is list else insert_value(items)
+                structure[key] = inserts
+                parent = AssetChange(time=base_time + timedelta(microseconds=i), asset=asset, parent=parent,
+                                     key=key, inserts=inserts)
+                self.objects[AssetChange].append(parent)
+            if parent is not None:
+                parent.structure_cache = structure
+
+    def rows(self) -> int:
+        return sum(len(objects) for objects in self.objects.values())
+
+    def load(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in LEAF_MODELS:
+                reserve_ids(cursor, model, self.objects[model])
+            self.build_changes()
+            for model in COPY_MODELS:
+                if len(self.objects[model]) > 0:
+                    copy_objects(cursor, model, self.objects[model])
+
+
+class Command(BaseCommand):
+    help = "Import NDJSON asset trees (one tree per line) with Postgres COPY. Every batch is loaded in its " + \
+           "own transaction, so the batches before an invalid line stay imported."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default="-",
+                            help="NDJSON file with one asset tree per line. Reads from stdin if omitted or '-'.")
+        parser.add_argument("--batch-size", type=int, default=10000,
+                            help="Number of asset trees which are loaded with one COPY per table")
+        parser.add_argument("--skip-invalid", action="store_true",
+                            help="Report invalid lines and continue instead of aborting the import")
+
+    def handle(self, *args, **options):
+        schema_types = SchemaTypes()
+        statistics = {
+            'imported_trees': 0,
+            'imported_assets': 0,
+            'imported_rows': 0,
+            'skipped_lines': 0
+        }
+        start = time.time()
+        input_file = sys.stdin if options["path"] == "-" else open(options["path"], encoding="utf-8")
+        try:
+            batch = AssetBatch(schema_types)
+            for line_number, line in enumerate(input_file, start=1):
+                if len(line.strip()) < 1:
+                    continue
+                try:
+                    tree = codec.loads(line)
+                    if type(tree) is not dict:
+                        raise AssetStructureError(tree, "Every line has to contain an Asset as a JSON-object.")
+                    check_asset(tree, schema_types=schema_types)
+                    batch.add_tree(tree)
+                except (codec.JSONDecodeError, AssetStructureError) as error:
+                    if not options["skip_invalid"]:
+                        raise CommandError("Line %d: %s" % (line_number, str(error)))
+                    statistics['skipped_lines'] += 1
+                    print("Skipped line %d: %s" % (line_number, str(error)), file=sys.stderr)
+                    continue
+                if batch.trees >= options["batch_size"]:
+                    self.load_batch(batch, statistics, start)
+                    batch = AssetBatch(schema_types)
+            if batch.trees > 0:
+                self.load_batch(batch, statistics, start)
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+        if statistics['imported_trees'] > 0:
+            WriteGeneration.bump()
+        for key in statistics.keys():
+            print(key + ":", statistics[key])
+
+    @staticmethod
+    def load_batch(batch: AssetBatch, statistics: dict, start: float):
+        batch_start = time.time()
+        batch.load()
+        rows = batch.rows()
+        statistics['imported_trees'] += batch.trees
+        statistics['imported_assets'] += len(batch.objects[Asset])
+        statistics['imported_rows'] += rows
+        batch_duration = max(time.time() - batch_start, 1e-6)
+        total_duration = max(time.time() - start, 1e-6)
+        print("Loaded %d trees (%d assets, %d rows) in %.2fs: %.0f assets/s, %.0f assets/s overall" % (
+            batch.trees, len(batch.objects[Asset]), rows, batch_duration,
+            len(batch.objects[Asset]) / batch_duration, statistics['imported_assets'] / total_duration))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import connection
+from AssetStorm.assets.models import CacheInvalidation
+from AssetStorm.assets.views import process_cache_invalidations
+import select
+
+
+class Command(BaseCommand):
+    help = "Drain the cache invalidation queue and rebuild the caches of all assets containing changed assets"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Number of queue entries which are claimed and processed in one batch")
+        parser.add_argument("--poll-interval", type=float, default=5,
+                            help="Seconds to wait for a notification before checking the queue again")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit when the queue is empty instead of waiting for new entries")
+
+    def drain(self, batch_size: int):
+        while True:
+            statistics = process_cache_invalidations(batch_size)
+            if statistics['processed_invalidations'] < 1:
+                break
+            print("processed_invalidations: %d rebuilt_content_caches: %d rendered_raw_templates: %d" % (
+                statistics['processed_invalidations'],
+                statistics['rebuilt_content_caches'],
+                statistics['rendered_raw_templates']))
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            self.drain(options["batch_size"])
+            return
+        with connection.cursor() as cursor:
+            cursor.execute("LISTEN " + CacheInvalidation.CHANNEL)
+        while True:
+            self.drain(options["batch_size"])
+            if select.select([connection.connection], [], [], options["poll_interval"])[0]:
+                connection.connection.poll()
+                connection.connection.notifies.clear()
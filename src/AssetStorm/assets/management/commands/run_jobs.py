@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from AssetStorm.assets.models import CacheRebuildJob
+from AssetStorm.assets.views import run_cache_rebuild_job
+import multiprocessing
+import select
+
+
+def run_queued_jobs() -> int:
+    """
+    Runs queued cache rebuild jobs until none is left and returns how many were run.
+    """
+    job_count = 0
+    job = CacheRebuildJob.claim()
+    while job is not None:
+        job = run_cache_rebuild_job(job)
+        print("job %s %s: rebuilt_content_caches: %d rendered_raw_templates: %d" % (
+            str(job.pk), job.status, job.rebuilt_content_caches, job.rendered_raw_templates))
+        job_count += 1
+        job = CacheRebuildJob.claim()
+    return job_count
+
+
+def work(poll_interval: float):
+    with connection.cursor() as cursor:
+        cursor.execute("LISTEN " + CacheRebuildJob.CHANNEL)
+    while True:
+        run_queued_jobs()
+        if select.select([connection.connection], [], [], poll_interval)[0]:
+            connection.connection.poll()
+            connection.connection.notifies.clear()
+
+
+class Command(BaseCommand):
+    help = "Run the cache rebuild jobs queued by /update_caches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=settings.JOB_CONCURRENCY,
+                            help="Number of worker processes which run jobs at the same time")
+        parser.add_argument("--poll-interval", type=float, default=5,
+                            help="Seconds to wait for a notification before checking the queue again")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit when no queued job is left instead of waiting for new ones")
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            run_queued_jobs()
+            return
+        if options["concurrency"] < 2:
+            work(options["poll_interval"])
+            return
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=work, args=(options["poll_interval"],))
+                   for _ in range(options["concurrency"])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
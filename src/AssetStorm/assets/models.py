@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.conf import settings
+from django.db import models, connection, transaction
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
 from django.db.models.fields.json import JSONField
 from django.contrib.postgres.fields import ArrayField
 from django.utils import timezone
+from AssetStorm.assets.caches import asset_cache, asset_cache_key, stale_asset_cache_key
+from AssetStorm.assets.locks import single_flight, lock_id, try_advisory_locks, advisory_unlock_many
+from AssetStorm.assets import codec
 from copy import deepcopy
+from datetime import timedelta
+from functools import partial
+import random
 import uuid
 import re
 
@@ -23,6 +32,27 @@ class EnumType(models.Model):
     items = ArrayField(models.TextField())
 
 
+# Number of head changes fetched per round trip while building the dependency graph of a cache rebuild
+DEPENDENCY_CHUNK_SIZE = 2000
+
+CONTENT_CACHE_FIELDS = [
+    "content_cache",
+    "serialized_content_cache",
+    "content_cache_versions",
+    "text_reference_list",
+    "uri_reference_list",
+    "enum_reference_list",
+    "asset_reference_list"
+]
+
+# All cache columns of an asset. Cache resets write only these, never the version, which is only
+# incremented in the database so concurrent writers can not undo each other's bumps.
+CACHE_FIELDS = CONTENT_CACHE_FIELDS + [
+    "raw_content_cache",
+    "raw_cache_versions"
+]
+
+
 class Asset(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     t = models.ForeignKey(AssetType, on_delete=models.CASCADE, related_name="assets")
@@ -35,6 +65,10 @@ class Asset(models.Model):
     revision_chain = models.ForeignKey("self", on_delete=models.SET_NULL,
                                        related_name="new_version", blank=True, null=True)
     raw_content_cache = models.TextField(null=True, default=None)
+    serialized_content_cache = models.BinaryField(null=True, default=None)
+    version = models.BigIntegerField(default=0)
+    content_cache_versions = JSONField(default=dict)
+    raw_cache_versions = JSONField(default=dict)
 
     def clear_reference_lists(self):
         self.text_reference_list.clear()
@@ -58,6 +92,10 @@ class Asset(models.Model):
         if sub_asset.pk not in self.asset_reference_list:
             self.asset_reference_list.append(sub_asset.pk)
 
+    def register_content_versions(self, sub_asset):
+        self.content_cache_versions.update(sub_asset.content_cache_versions)
+        self.content_cache_versions[str(sub_asset.pk)] = sub_asset.version
+
     def get_asset_content(self, content_type, content_id):
         if content_type == 1:  # text
             text = Text.objects.get(pk=content_id)
@@ -74,7 +112,36 @@ class Asset(models.Model):
         else:
             sub_asset = Asset.objects.get(pk=uuid.UUID(content_id))
             self.register_reference_to_sub_asset(sub_asset)
-            return sub_asset.content
+            sub_asset_content = sub_asset.content
+            self.register_content_versions(sub_asset)
+            return sub_asset_content
+
+    def get_prefetched_asset_content(self, prefetched, content_type, content_id):
+        if content_type == 1:  # text
+            model = Text
+        elif content_type == 2:  # uri-element
+            model = UriElement
+        elif type(content_type) is dict and "3" in content_type:  # enum
+            model = Enum
+        else:
+            model = Asset
+        object_id = uuid.UUID(str(content_id)) if model is Asset else int(content_id)
+        if object_id not in prefetched[model]:
+            return self.get_asset_content(content_type, content_id)
+        referenced_object = prefetched[model][object_id]
+        if model is Text:
+            self.register_reference_to_text(referenced_object)
+            return referenced_object.text
+        elif model is UriElement:
+            self.register_reference_to_uri(referenced_object)
+            return referenced_object.uri
+        elif model is Enum:
+            self.register_reference_to_enum(referenced_object)
+            return referenced_object.item
+        else:
+            self.register_reference_to_sub_asset(referenced_object)
+            self.register_content_versions(referenced_object)
+            return referenced_object.content_cache
 
     @property
     def change_chain(self):
@@ -83,38 +150,399 @@ class Asset(models.Model):
         else:
             return None
 
-    @property
-    def content(self):
-        if self.content_cache is not None:
-            return self.content_cache
-        self.clear_reference_lists()
-        self.content_cache = {
+    def build_content(self, structure, get_asset_content):
+        content = {
             'type': self.t.type_name,
             'id': str(self.pk)
         }
-        for k in self.change_chain.structure.keys():
+        for k in structure.keys():
             if type(self.t.schema[k]) is list:
                 asset_content = [
-                    self.get_asset_content(self.t.schema[k][0], e)
-                    for e in self.change_chain.structure[k]
+                    get_asset_content(self.t.schema[k][0], e)
+                    for e in structure[k]
                 ]
-            elif type(self.t.schema[k]) is dict and \
-                    len(self.t.schema[k].keys()) == 1 and \
-                    "3" in self.t.schema[k].keys():
-                asset_content = self.get_asset_content(self.t.schema[k], self.change_chain.structure[k])
             else:
-                asset_content = self.get_asset_content(self.t.schema[k], self.change_chain.structure[k])
-            self.content_cache[k] = asset_content
-        self.save()
+                asset_content = get_asset_content(self.t.schema[k], structure[k])
+            content[k] = asset_content
+        return content
+
+    def build_content_cache(self, structure, get_asset_content):
+        self.clear_reference_lists()
+        self.content_cache_versions = {}
+        self.content_cache = self.build_content(structure, get_asset_content)
+        self.serialized_content_cache = codec.dumps(self.content_cache)
+        return self.content_cache
+
+    @classmethod
+    def current_versions(cls, recorded_versions: list):
+        """
+        Fetches the current versions of all assets mentioned in a list of recorded versions with one query.
+        """
+        asset_ids = set()
+        for versions in recorded_versions:
+            asset_ids.update(versions.keys())
+        if len(asset_ids) < 1:
+            return {}
+        return {str(pk): version for pk, version in cls.objects.filter(pk__in=asset_ids).values_list("pk", "version")}
+
+    @staticmethod
+    def versions_match(recorded_versions: dict, current_versions: dict):
+        return all(current_versions.get(pk) == version for pk, version in recorded_versions.items())
+
+    def content_cache_is_fresh(self):
+        return self.content_cache is not None and Asset.versions_match(
+            self.content_cache_versions, Asset.current_versions([self.content_cache_versions]))
+
+    def raw_content_cache_is_fresh(self):
+        return self.raw_content_cache is not None and Asset.versions_match(
+            self.raw_cache_versions, Asset.current_versions([self.raw_cache_versions]))
+
+    @property
+    def content(self):
+        if self.content_cache_is_fresh():
+            return self.content_cache
+        with single_flight(lock_id("content_cache", self.pk)) as flight:
+            if flight.waited:
+                self.refresh_from_db(fields=CONTENT_CACHE_FIELDS)
+                if self.content_cache_is_fresh():
+                    return self.content_cache
+            self.build_content_cache(self.change_chain.structure, self.get_asset_content)
+            self.save(update_fields=CONTENT_CACHE_FIELDS)
+        WriteGeneration.bump()
         return self.content_cache
 
+    @staticmethod
+    def truncate_content(content: dict, depth: int):
+        """
+        Replaces all sub-assets deeper than depth in a content tree with stubs containing only id and type.
+        """
+        if depth < 0:
+            return {'type': content['type'], 'id': content['id']}
+
+        def truncate(value):
+            if type(value) is dict:
+                return Asset.truncate_content(value, depth - 1)
+            if type(value) is list:
+                return [truncate(item) for item in value]
+            return value
+
+        return {key: truncate(value) for key, value in content.items()}
+
+    def content_to_depth(self, depth: int):
+        """
+        Returns the content with sub-assets inlined up to the given depth. Deeper sub-assets are replaced
+        by stubs. A warm content cache gets truncated. Without one only the requested levels are resolved
+        and the content cache stays empty.
+        """
+        if depth < 0:
+            return Asset.truncate_content(self.content_cache or {'type': self.t.type_name, 'id': str(self.pk)},
+                                          depth)
+        if self.content_cache_is_fresh():
+            return Asset.truncate_content(self.content_cache, depth)
+
+        def get_asset_content(content_type, content_id):
+            if content_type in [1, 2] or (type(content_type) is dict and "3" in content_type):
+                return self.get_asset_content(content_type, content_id)
+            sub_asset = Asset.objects.select_related("t").get(pk=uuid.UUID(str(content_id)))
+            return sub_asset.content_to_depth(depth - 1)
+
+        return self.build_content(self.change_chain.structure, get_asset_content)
+
+    def structure_at(self, at):
+        """
+        Returns the structure of the asset at the given time or None if it had no changes until then.
+        Starts from the newest cached structure up to that time and replays only the changes after it.
+        Nothing gets saved.
+        """
+        changes = self.changes.filter(time__lte=at)
+        cached_change = changes.filter(structure_cache__isnull=False).order_by("-time").first()
+        if cached_change is not None:
+            structure = deepcopy(cached_change.structure_cache)
+            changes = changes.filter(time__gt=cached_change.time)
+        elif changes.exists():
+            structure = AssetChange.empty_structure(self.t.schema)
+        else:
+            return None
+        for change in changes.defer("structure_cache").order_by("time"):
+            change.apply_to(structure)
+        return structure
+
+    def content_at(self, at, depth: int = None):
+        """
+        Returns the content the asset had at the given time with all sub-assets in their state of that time.
+        Sub-assets deeper than depth or without changes until then are replaced by stubs. Returns None if
+        the asset itself had no changes until then. Content caches are neither used nor written.
+        """
+        structure = self.structure_at(at)
+        if structure is None:
+            return None
+
+        def get_asset_content(content_type, content_id):
+            if content_type in [1, 2] or (type(content_type) is dict and "3" in content_type):
+                return self.get_asset_content(content_type, content_id)
+            sub_asset = Asset.objects.select_related("t").get(pk=uuid.UUID(str(content_id)))
+            stub = {'type': sub_asset.t.type_name, 'id': str(sub_asset.pk)}
+            if depth is not None and depth < 1:
+                return stub
+            return sub_asset.content_at(at, None if depth is None else depth - 1) or stub
+
+        return self.build_content(structure, get_asset_content)
+
+    @classmethod
+    def head_structures(cls, asset_ids: list):
+        """
+        Returns the current structures of the given assets with one query for the newest change of each asset.
+        """
+        return {
+            change.asset_id: change.structure
+            for change in AssetChange.objects.filter(
+                asset_id__in=asset_ids).order_by("asset_id", "-time").distinct("asset_id")
+        }
+
+    @staticmethod
+    def structure_references(schema: dict, structure: dict):
+        """
+        Yields a (model, id) tuple for every Text, UriElement, Enum and sub-asset referenced in structure.
+        """
+        for key, content in structure.items():
+            content_type = schema[key]
+            if type(content_type) is list:
+                content_type = content_type[0]
+            else:
+                content = [content]
+            for pk in content:
+                if content_type == 1:
+                    yield Text, int(pk)
+                elif content_type == 2:
+                    yield UriElement, int(pk)
+                elif type(content_type) is dict and "3" in content_type:
+                    yield Enum, int(pk)
+                else:
+                    yield Asset, uuid.UUID(str(pk))
+
+    @classmethod
+    def dependency_levels(cls, asset_ids: list):
+        """
+        Sorts the given assets topologically by their sub-assets. The first level contains all assets which
+        do not contain any other of the given assets. The sub-assets of every asset in a further level are
+        all in earlier levels. Assets in reference cycles end up together in the last level.
+        The head structures are streamed from a server-side cursor and dropped as soon as their sub-asset ids
+        are extracted, so only the dependency graph of the given ids is held in memory.
+        """
+        pending_count = {asset_id: 0 for asset_id in asset_ids}
+        parents = {asset_id: [] for asset_id in asset_ids}
+        schemas = dict(AssetType.objects.values_list("pk", "schema"))
+        head_changes = AssetChange.objects.filter(asset_id__in=RawSQL(
+            "SELECT unnest(%s::uuid[])", [[str(asset_id) for asset_id in asset_ids]])).order_by(
+            "asset_id", "-time").distinct("asset_id").values_list("pk", "asset_id", "asset__t_id", "structure_cache")
+        for change_id, asset_id, type_id, structure in head_changes.iterator(chunk_size=DEPENDENCY_CHUNK_SIZE):
+            if structure is None:
+                structure = AssetChange.objects.get(pk=change_id).structure
+            sub_asset_ids = set(object_id for model, object_id in cls.structure_references(
+                schemas[type_id], structure) if model is Asset and object_id in pending_count)
+            for sub_asset_id in sub_asset_ids:
+                parents[sub_asset_id].append(asset_id)
+            pending_count[asset_id] = len(sub_asset_ids)
+        levels = []
+        level = [asset_id for asset_id, count in pending_count.items() if count == 0]
+        while len(level) > 0:
+            levels.append(level)
+            next_level = []
+            for asset_id in level:
+                for parent_id in parents[asset_id]:
+                    pending_count[parent_id] -= 1
+                    if pending_count[parent_id] == 0:
+                        next_level.append(parent_id)
+            level = next_level
+        cyclic_assets = [asset_id for asset_id, count in pending_count.items() if count > 0]
+        if len(cyclic_assets) > 0:
+            levels.append(cyclic_assets)
+        return levels
+
+    @classmethod
+    def load_contents(cls, assets: list):
+        """
+        Returns the contents of the given assets in the same order. Fresh content caches are used as they
+        are. All cold or outdated assets are rebuilt together: their leaves are fetched with one query per
+        table and their sub-assets are resolved level by level with the same batched method.
+        Every rebuilt asset is locked single-flight like in Asset.content. Assets which are locked by another
+        process are re-read after it finished and only rebuilt here if they are still not fresh.
+        """
+        current_versions = cls.current_versions([
+            asset.content_cache_versions for asset in assets if asset.content_cache is not None])
+        cold_assets = [asset for asset in assets if asset.content_cache is None or
+                       not cls.versions_match(asset.content_cache_versions, current_versions)]
+        lock_keys = [lock_id("content_cache", asset.pk) for asset in cold_assets]
+        acquired = try_advisory_locks(lock_keys)
+        busy_assets = [asset for asset, asset_acquired in zip(cold_assets, acquired) if not asset_acquired]
+        cold_assets = [asset for asset, asset_acquired in zip(cold_assets, acquired) if asset_acquired]
+        try:
+            cls.build_content_caches(cold_assets)
+        finally:
+            advisory_unlock_many([key for key, key_acquired in zip(lock_keys, acquired) if key_acquired])
+        for asset in busy_assets:
+            with single_flight(lock_id("content_cache", asset.pk)):
+                asset.refresh_from_db(fields=CONTENT_CACHE_FIELDS)
+                if not asset.content_cache_is_fresh():
+                    cls.load_contents([asset])
+        return [asset.content_cache for asset in assets]
+
+    @classmethod
+    def build_content_caches(cls, cold_assets: list):
+        if len(cold_assets) > 0:
+            structures = cls.head_structures([asset.pk for asset in cold_assets])
+            referenced_ids = {Text: set(), UriElement: set(), Enum: set(), Asset: set()}
+            for asset in cold_assets:
+                for model, object_id in cls.structure_references(asset.t.schema, structures[asset.pk]):
+                    referenced_ids[model].add(object_id)
+            prefetched = {
+                Text: Text.objects.in_bulk(referenced_ids[Text]),
+                UriElement: UriElement.objects.in_bulk(referenced_ids[UriElement]),
+                Enum: Enum.objects.in_bulk(referenced_ids[Enum]),
+                Asset: cls.objects.select_related("t").defer(
+                    "raw_content_cache", "serialized_content_cache").in_bulk(referenced_ids[Asset])
+            }
+            cls.load_contents(list(prefetched[Asset].values()))
+            for asset in cold_assets:
+                asset.build_content_cache(structures[asset.pk],
+                                          partial(asset.get_prefetched_asset_content, prefetched))
+            cls.objects.bulk_update(cold_assets, CONTENT_CACHE_FIELDS)
+            WriteGeneration.bump()
+
+    @classmethod
+    def load_serialized_contents(cls, asset_ids: list):
+        """
+        Returns a dict which maps the ids of all existing assets in asset_ids to a tuple of their content
+        as UTF-8 encoded JSON and the versions of the asset and all sub-assets it was built from. Fresh assets
+        only read the serialized cache column. Cold or outdated ones get rebuilt with load_contents.
+        """
+        serialized_contents = {
+            pk: (None if serialized_content is None else bytes(serialized_content),
+                 cls.shared_cache_versions(pk, version, versions))
+            for pk, serialized_content, version, versions in cls.objects.filter(pk__in=asset_ids).values_list(
+                "pk", "serialized_content_cache", "version", "content_cache_versions")
+        }
+        current_versions = cls.current_versions([versions for _, versions in serialized_contents.values()])
+        cold_ids = [pk for pk, (serialized_content, versions) in serialized_contents.items()
+                    if serialized_content is None or not cls.versions_match(versions, current_versions)]
+        if len(cold_ids) > 0:
+            cold_assets = list(cls.objects.select_related("t").defer("raw_content_cache").filter(pk__in=cold_ids))
+            cls.load_contents(cold_assets)
+            unserialized_assets = [asset for asset in cold_assets if asset.serialized_content_cache is None]
+            for asset in unserialized_assets:
+                asset.serialized_content_cache = codec.dumps(asset.content_cache)
+            cls.objects.bulk_update(unserialized_assets, ["serialized_content_cache"])
+            for asset in cold_assets:
+                serialized_contents[asset.pk] = (bytes(asset.serialized_content_cache), cls.shared_cache_versions(
+                    asset.pk, asset.version, asset.content_cache_versions))
+        return serialized_contents
+
+    @staticmethod
+    def shared_cache_versions(asset_id, version: int, content_cache_versions: dict) -> dict:
+        """
+        The versions a shared cache entry depends on: the ones of all sub-assets and the asset's own version,
+        so an entry written from a row read before an edit committed is never taken as fresh.
+        """
+        versions = dict(content_cache_versions)
+        versions[str(asset_id)] = version
+        return versions
+
+    @classmethod
+    def outdated_cache_ids_sql(cls, versions_field: str, restricted: bool = False):
+        """
+        SQL which selects the ids of all assets whose cache in versions_field was built from a sub-asset
+        which got a new version since (or does not exist anymore). If restricted is True only the assets
+        in the uuid array passed as the only parameter are checked.
+        """
+        return "SELECT DISTINCT cached.id FROM {table} cached " \
+               "CROSS JOIN LATERAL jsonb_each_text(cached.{field}) AS recorded(asset_id, version) " \
+               "LEFT JOIN {table} sub_asset ON sub_asset.id = recorded.asset_id::uuid " \
+               "WHERE {restriction}(sub_asset.id IS NULL OR sub_asset.version <> recorded.version::bigint)".format(
+                   table=cls._meta.db_table, field=versions_field,
+                   restriction="cached.id = ANY(%s::uuid[]) AND " if restricted else "")
+
+    @classmethod
+    def fresh_cache_sql(cls, versions_field: str):
+        """
+        SQL condition on the asset table of the surrounding query which is true if the cache in versions_field
+        was built from the current versions of all its sub-assets. It only looks at the recorded versions of
+        the rows the surrounding query already selected.
+        """
+        return "NOT EXISTS (SELECT 1 FROM jsonb_each_text({table}.{field}) AS recorded(asset_id, version) " \
+               "LEFT JOIN {table} sub_asset ON sub_asset.id = recorded.asset_id::uuid " \
+               "WHERE sub_asset.id IS NULL OR sub_asset.version <> recorded.version::bigint)".format(
+                   table=cls._meta.db_table, field=versions_field)
+
+    @classmethod
+    def revision_history(cls, asset_id, offset: int, limit: int):
+        """
+        Walks the revision_chain of an asset with one recursive query and returns a list of dicts with the
+        metadata of up to limit revisions, starting offset revisions before the current one. Revision 0 is
+        the asset itself. The walk stops after offset + limit steps, so cycles can not loop forever.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "WITH RECURSIVE history(id, revision_chain_id, revision) AS ("
+                "SELECT id, revision_chain_id, 0 FROM {asset_table} WHERE id = %s "
+                "UNION ALL "
+                "SELECT previous.id, previous.revision_chain_id, history.revision + 1 FROM {asset_table} previous "
+                "JOIN history ON previous.id = history.revision_chain_id WHERE history.revision + 1 < %s) "
+                "SELECT history.id, history.revision, history.revision_chain_id, asset_type.type_name, "
+                "(SELECT MAX(change.time) FROM {change_table} change WHERE change.asset_id = history.id) "
+                "FROM history JOIN {asset_table} asset ON asset.id = history.id "
+                "JOIN {type_table} asset_type ON asset_type.id = asset.t_id "
+                "WHERE history.revision >= %s ORDER BY history.revision".format(
+                    asset_table=cls._meta.db_table,
+                    change_table=AssetChange._meta.db_table,
+                    type_table=AssetType._meta.db_table),
+                [asset_id, offset + limit, offset])
+            return [{
+                "id": str(revision_id),
+                "revision": revision,
+                "previous_id": None if previous_id is None else str(previous_id),
+                "type": type_name,
+                "changed": None if changed is None else changed.isoformat()
+            } for revision_id, revision, previous_id, type_name, changed in cursor.fetchall()]
+
     def clear_cache(self):
-        for asset in Asset.objects.filter(asset_reference_list__contains=[self.pk]):
-            asset.clear_cache()
+        """
+        Resets the caches of this asset and increments its version. The caches of other assets which
+        contain this asset are not touched. They recognize the new version when they are read.
+        """
+        self.reset_caches()
+        asset_cache().delete(asset_cache_key(self.pk))
+        WriteGeneration.bump()
+
+    def invalidate(self):
+        """
+        Resets the caches of this asset, increments its version and queues it for the process_invalidations
+        worker which re-renders the assets containing it. Runs in the transaction of the change, so the
+        queue entry is only visible if the change gets committed.
+        """
+        self.reset_caches()
+        CacheInvalidation.enqueue([self.pk])
+        transaction.on_commit(partial(asset_cache().delete, asset_cache_key(self.pk)))
+
+    def keep_stale_content(self):
+        """
+        Keeps the serialized content in the shared cache as the last known value, which /load serves while
+        another process rebuilds the content cache.
+        """
+        if self.serialized_content_cache is not None:
+            asset_cache().set(stale_asset_cache_key(self.pk), bytes(self.serialized_content_cache))
+
+    def reset_caches(self):
+        self.keep_stale_content()
         self.content_cache = None
+        self.serialized_content_cache = None
         self.raw_content_cache = None
+        self.content_cache_versions = {}
+        self.raw_cache_versions = {}
         self.clear_reference_lists()
-        self.save()
+        self.save(update_fields=CACHE_FIELDS)
+        self.rendered_templates.all().delete()
+        Asset.objects.filter(pk=self.pk).update(version=F("version") + 1)
+        self.refresh_from_db(fields=["version"])
 
     @classmethod
     def produce(cls, t: AssetType, content_ids: dict):
@@ -132,25 +560,113 @@ class Asset(models.Model):
     def change(self, key: str, position: int = 0, delete_count: int = 0, inserts=None):
         if inserts is None:
             inserts = []
-        new_change = AssetChange(asset=self, parent=self.change_chain, key=key,
+        new_change = AssetChange(time=timezone.now(), asset=self, parent=self.change_chain, key=key,
                                  position=position, delete=delete_count, inserts=inserts)
         new_change.bubble()
 
-    def render_template(self, template_key="raw"):
+    def record_revision_snapshot(self, structure: dict, head_change=None):
+        """
+        Gives a revision copy made by modify_asset one squashed change which holds the structure the asset had
+        when it was replaced, so the copy can be diffed like any other asset. The change keeps the time of the
+        last change before the replacement.
+        """
+        keys = list(self.t.schema.keys())
+        if len(keys) < 1:
+            return
+        AssetChange(time=timezone.now() if head_change is None else head_change.time, asset=self, key=keys[0],
+                    inserts=deepcopy(structure[keys[0]]), structure_cache=deepcopy(structure), squashed=True).save()
+
+    def render_template(self, template_key="raw", shared=None):
+        """
+        Renders the template and stores the result in the raw_content_cache or a RenderedTemplate.
+        shared is an optional dict which keeps loaded leaves, sub-assets and renders across several calls,
+        so rendering many assets in several formats loads and renders every sub-asset only once.
+        """
+        return self.render_template_with_versions(template_key, shared)[0]
+
+    def render_template_with_versions(self, template_key="raw", shared=None):
+        """
+        Returns the rendered template with the versions of all sub-assets it was rendered from.
+        """
+        if shared is not None and ("render", self.pk, template_key) in shared:
+            return shared[("render", self.pk, template_key)]
+        if template_key not in self.t.templates.keys():
+            rendering = ("", {})
+        elif template_key == "raw":
+            rendering = (self.render_raw_template(shared), self.raw_cache_versions)
+        else:
+            rendering = self.render_stored_template(template_key, shared)
+        if shared is not None:
+            shared[("render", self.pk, template_key)] = rendering
+        return rendering
+
+    def render_raw_template(self, shared=None):
+        if self.raw_content_cache_is_fresh():
+            return self.raw_content_cache
+        with single_flight(lock_id("raw_content_cache", self.pk)) as flight:
+            if flight.waited:
+                self.refresh_from_db(fields=["raw_content_cache", "raw_cache_versions"])
+                if self.raw_content_cache_is_fresh():
+                    return self.raw_content_cache
+            raw_cache_versions = {}
+            self.raw_content_cache = self.fill_template("raw", raw_cache_versions, shared)
+            self.raw_cache_versions = raw_cache_versions
+            self.save(update_fields=["raw_content_cache", "raw_cache_versions"])
+        WriteGeneration.bump()
+        return self.raw_content_cache
+
+    def render_stored_template(self, template_key, shared=None):
+        def fresh_rendering():
+            stored = self.rendered_templates.filter(template_key=template_key).first()
+            if stored is not None and Asset.versions_match(stored.versions, Asset.current_versions([stored.versions])):
+                return stored.content, stored.versions
+            return None
+
+        rendering = fresh_rendering()
+        if rendering is not None:
+            return rendering
+        with single_flight(lock_id("rendered_template", self.pk, template_key)) as flight:
+            if flight.waited:
+                rendering = fresh_rendering()
+                if rendering is not None:
+                    return rendering
+            versions = {}
+            content = self.fill_template(template_key, versions, shared)
+            RenderedTemplate.objects.update_or_create(asset=self, template_key=template_key, defaults={
+                "content": content,
+                "versions": versions
+            })
+        return content, versions
+
+    def fill_template(self, template_key, versions=None, shared=None):
+        if shared is None:
+            shared = {}
+
+        def load(model, pk):
+            if (model, pk) not in shared:
+                shared[(model, pk)] = model.objects.get(pk=pk)
+            return shared[(model, pk)]
+
         def get_key_content(type_id, pk):
             if type_id == 1:
-                return Text.objects.get(pk=pk).text
+                return load(Text, pk).text
             if type_id == 2:
-                return UriElement.objects.get(pk=pk).uri
+                return load(UriElement, pk).uri
             if type(type_id) is dict and "3" in type_id:
-                return Enum.objects.get(pk=pk).item
-            return Asset.objects.get(pk=pk).render_template(template_key=template_key)
+                return load(Enum, pk).item
+            sub_asset = load(Asset, pk)
+            rendered_content, sub_asset_versions = sub_asset.render_template_with_versions(
+                template_key=template_key, shared=shared)
+            if versions is not None:
+                versions.update(sub_asset_versions)
+                versions[str(sub_asset.pk)] = sub_asset.version
+            return rendered_content
+
+        def get_structure():
+            if ("structure", self.pk) not in shared:
+                shared[("structure", self.pk)] = self.change_chain.structure
+            return shared[("structure", self.pk)]
 
-        if template_key not in self.t.templates.keys():
-            return ""
-        if template_key == "raw":
-            if self.raw_content_cache is not None:
-                return self.raw_content_cache
         consumable_template = self.t.templates[template_key]
         for key in self.t.schema.keys():
             key_list_regex = r"^(?P<start_part>[\s\S]*?){{for\(" + key + \
@@ -159,7 +675,7 @@ class Asset(models.Model):
             list_matches = re.match(key_list_regex, consumable_template, re.MULTILINE)
             while list_matches and type(self.t.schema[key]) is list:
                 list_content = ""
-                for pk in self.change_chain.structure[key]:
+                for pk in get_structure()[key]:
                     consumable_list_template = list_matches.groupdict()["list_template"]
                     matches = re.match(key_regex, consumable_list_template, re.MULTILINE)
                     while matches:
@@ -174,11 +690,8 @@ class Asset(models.Model):
             matches = re.match(key_regex, consumable_template, re.MULTILINE)
             while matches:
                 consumable_template = matches.groupdict()["start_part"] + get_key_content(
-                    self.t.schema[key], self.change_chain.structure[key]) + matches.groupdict()["end_part"]
+                    self.t.schema[key], get_structure()[key]) + matches.groupdict()["end_part"]
                 matches = re.match(key_regex, consumable_template, re.MULTILINE)
-        if template_key == "raw":
-            self.raw_content_cache = consumable_template
-            self.save()
         return consumable_template
 
 
@@ -192,6 +705,7 @@ class AssetChange(models.Model):
     delete = models.IntegerField(default=0)
     inserts = JSONField(blank=True, null=True, default=None)
     structure_cache = JSONField(blank=True, null=True, default=None)
+    squashed = models.BooleanField(default=False)
 
     def __str__(self):
         return "<AssetChange %s Key:%s (%d|%d|%s) -- %s>" % (self.pk, self.key,
@@ -204,27 +718,31 @@ class AssetChange(models.Model):
             return self.structure_cache
         else:
             if self.parent is None:
-                structure = deepcopy(self.asset.t.schema)
-                for key in structure.keys():
-                    if type(structure[key]) is list:
-                        structure[key] = []
-                    else:
-                        structure[key] = None
+                structure = AssetChange.empty_structure(self.asset.t.schema)
             else:
                 structure = self.parent.structure
-            if type(structure[self.key]) is list:
-                del structure[self.key][self.position:self.position+self.delete]
-                for i, insertion in enumerate(self.inserts):
-                    structure[self.key].insert(self.position + i, insertion)
-            else:
-                structure[self.key] = self.inserts
+            self.apply_to(structure)
             self.structure_cache = structure
             self.save()
             return structure
 
+    @staticmethod
+    def empty_structure(schema: dict):
+        return {key: [] if type(content_type) is list else None for key, content_type in schema.items()}
+
+    def apply_to(self, structure):
+        if type(structure[self.key]) is list:
+            del structure[self.key][self.position:self.position+self.delete]
+            for i, insertion in enumerate(self.inserts):
+                structure[self.key].insert(self.position + i, insertion)
+        else:
+            structure[self.key] = self.inserts
+        return structure
+
     def invalidate_structure_cache(self):
-        self.structure_cache = None
-        self.save()
+        if not self.squashed:
+            self.structure_cache = None
+            self.save()
         for c in self.child:
             c.invalidate_structure_cache()
 
@@ -242,6 +760,55 @@ class AssetChange(models.Model):
             self.save()
             return self
 
+    @classmethod
+    def compact(cls, asset_id, horizon) -> dict:
+        """
+        Squashes all changes of an asset older than horizon into the newest of them. That base change keeps the
+        full structure of its time in structure_cache and loses its parent, the older changes are deleted.
+        The structure caches of the retained changes between the base and the newest change are dropped because
+        they can be replayed from the base. The replayed current structure is compared with the stored one and
+        StructureError is raised if they differ, so the caller's transaction can roll everything back.
+        """
+        statistics = {
+            'squashed_changes': 0,
+            'dropped_structure_caches': 0
+        }
+        changes = list(cls.objects.filter(asset_id=asset_id).order_by("time"))
+        old_changes = [change for change in changes if change.time < horizon]
+        if len(old_changes) < 2:
+            return statistics
+        head_structure = deepcopy(changes[-1].structure)
+        base = old_changes[-1]
+        base.structure_cache = deepcopy(base.structure)
+        base.parent = None
+        base.squashed = True
+        base.save()
+        cls.objects.filter(pk__in=[change.pk for change in old_changes[:-1]]).delete()
+        statistics['squashed_changes'] = len(old_changes) - 1
+        retained_changes = changes[len(old_changes):]
+        statistics['dropped_structure_caches'] = cls.objects.filter(
+            pk__in=[change.pk for change in retained_changes[:-1]], structure_cache__isnull=False).update(
+            structure_cache=None)
+        replayed_structure = deepcopy(base.structure_cache)
+        for change in retained_changes:
+            change.apply_to(replayed_structure)
+        if replayed_structure != head_structure:
+            raise StructureError("Compacting the changes of asset %s would change its structure." % str(asset_id))
+        return statistics
+
+
+class RenderedTemplate(models.Model):
+    """
+    Persistent cache for the renderings of all templates except raw, which lives in Asset.raw_content_cache.
+    """
+    asset = models.ForeignKey(Asset, on_delete=models.CASCADE, related_name="rendered_templates")
+    template_key = models.CharField(max_length=128)
+    content = models.TextField()
+    versions = JSONField(default=dict)
+
+    class Meta:
+        unique_together = [("asset", "template_key")]
+
 
 class Text(models.Model):
     text = models.TextField()
@@ -256,5 +823,169 @@ class Enum(models.Model):
     item = models.TextField()
 
 
+class AssetAccessStatistic(models.Model):
+    asset = models.OneToOneField(Asset, on_delete=models.CASCADE, primary_key=True,
+                                 related_name="access_statistic")
+    access_count = models.BigIntegerField(default=0)
+
+    @classmethod
+    def record(cls, asset_ids: list):
+        """
+        Counts an access to the given assets for a random sample (settings.ACCESS_SAMPLE_RATE) of all calls.
+        Recorded accesses are weighted with the inverse sample rate so the counts estimate the real numbers.
+        All assets of one call are counted with a single upsert.
+        """
+        sample_rate = settings.ACCESS_SAMPLE_RATE
+        if len(asset_ids) < 1 or sample_rate <= 0 or random.random() >= sample_rate:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {statistic_table} (asset_id, access_count) "
+                "SELECT id, %s FROM {asset_table} WHERE id = ANY(%s::uuid[]) ORDER BY id "
+                "ON CONFLICT (asset_id) DO UPDATE "
+                "SET access_count = {statistic_table}.access_count + EXCLUDED.access_count".format(
+                    statistic_table=cls._meta.db_table, asset_table=Asset._meta.db_table),
+                [max(1, round(1 / sample_rate)), sorted(str(asset_id) for asset_id in set(asset_ids))])
+
+
+class CacheBuildCheckpoint(models.Model):
+    """
+    Remembers the last asset id an interrupted build_caches run has finished, per set of filters.
+    """
+    key = models.CharField(unique=True, max_length=512)
+    last_asset_id = models.UUIDField()
+    updated = models.DateTimeField(auto_now=True)
+
+
+class CacheInvalidation(models.Model):
+    """
+    Durable queue of changed assets. The process_invalidations command drains it and re-renders the
+    caches of all assets which were built from the changed ones.
+    """
+    CHANNEL = "asset_invalidations"
+    asset_id = models.UUIDField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def enqueue(cls, asset_ids: list):
+        cls.objects.bulk_create([cls(asset_id=asset_id) for asset_id in asset_ids])
+        with connection.cursor() as cursor:
+            cursor.execute("NOTIFY " + cls.CHANNEL)
+
+    @classmethod
+    def claim(cls, batch_size: int):
+        """
+        Removes up to batch_size of the oldest entries and returns their distinct asset ids. Entries locked
+        by other workers are skipped.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM {table} WHERE id IN (SELECT id FROM {table} ORDER BY id LIMIT %s "
+                "FOR UPDATE SKIP LOCKED) RETURNING asset_id".format(table=cls._meta.db_table), [batch_size])
+            return list({row[0] for row in cursor.fetchall()})
+
+
+class CacheRebuildJob(models.Model):
+    """
+    A rebuild of all missing or outdated caches requested through /update_caches. The run_jobs command
+    executes the queued jobs and records their progress.
+    """
+    CHANNEL = "cache_rebuild_jobs"
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, default=QUEUED)
+    content_caches_total = models.IntegerField(blank=True, null=True)
+    rebuilt_content_caches = models.IntegerField(default=0)
+    raw_templates_total = models.IntegerField(blank=True, null=True)
+    rendered_raw_templates = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    @classmethod
+    def enqueue(cls):
+        """
+        Returns the oldest job which has not started yet or creates a new one, because a queued job will
+        already rebuild everything a new one would.
+        """
+        job = cls.objects.filter(status=cls.QUEUED).order_by("created").first()
+        if job is None:
+            job = cls.objects.create()
+            with connection.cursor() as cursor:
+                cursor.execute("NOTIFY " + cls.CHANNEL)
+        return job
+
+    @classmethod
+    def claim(cls):
+        """
+        Marks the oldest queued job as running and returns it. Jobs claimed by other workers are skipped.
+        Running jobs without a heartbeat for settings.JOB_STALE_AFTER seconds belong to a crashed worker and
+        get claimed again.
+        """
+        with transaction.atomic():
+            job = cls.objects.select_for_update(skip_locked=True).filter(
+                Q(status=cls.QUEUED) |
+                Q(status=cls.RUNNING,
+                  heartbeat__lt=timezone.now() - timedelta(seconds=settings.JOB_STALE_AFTER))).order_by(
+                "created").first()
+            if job is None:
+                return None
+            job.status = cls.RUNNING
+            job.started = timezone.now()
+            job.heartbeat = job.started
+            job.save(update_fields=["status", "started", "heartbeat"])
+        return job
+
+    def as_dict(self):
+        return {
+            "id": str(self.pk),
+            "status": self.status,
+            "content_caches_total": self.content_caches_total,
+            "rebuilt_content_caches": self.rebuilt_content_caches,
+            "raw_templates_total": self.raw_templates_total,
+            "rendered_raw_templates": self.rendered_raw_templates,
+            "error": self.error,
+            "created": self.created.isoformat(),
+            "started": None if self.started is None else self.started.isoformat(),
+            "heartbeat": None if self.heartbeat is None else self.heartbeat.isoformat(),
+            "finished": None if self.finished is None else self.finished.isoformat()
+        }
+
+
+class GarbageMark(models.Model):
+    """
+    A Text, UriElement, Enum or Asset which was unreferenced when collect_garbage marked it. The next run
+    after the grace period deletes it if it is still unreferenced.
+    """
+    kind = models.CharField(max_length=16)
+    object_id = models.CharField(max_length=36)
+    marked = models.DateTimeField()
+
+    class Meta:
+        unique_together = [("kind", "object_id")]
+
+
+class WriteGeneration(models.Model):
+    """
+    Global counter which gets incremented after every write that may change search results.
+    Result caches tag their entries with the generation they were computed in.
+    """
+    generation = models.BigIntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.get_or_create(pk=1)[0].generation
+
+    @classmethod
+    def bump(cls):
+        if cls.objects.filter(pk=1).update(generation=F("generation") + 1) < 1:
+            cls.objects.get_or_create(pk=1, defaults={"generation": 1})
+
+
 class StructureError(Exception):
     pass
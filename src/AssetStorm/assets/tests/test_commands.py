@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import override_settings
+from django.utils import timezone
 
-from AssetStorm.assets.models import Text, Asset, AssetType
+from AssetStorm.assets.models import Text, Asset, AssetType, AssetAccessStatistic, CacheBuildCheckpoint
+from AssetStorm.assets.models import CacheInvalidation, RenderedTemplate, AssetChange, GarbageMark
+from datetime import timedelta
+import json
+import os
+import tempfile
+import uuid
 
 
 class TestBuildCaches(TestCase):
@@ -80,3 +89,259 @@ class TestBuildCaches(TestCase):
             "text": "Text2"
         })
         self.assertEqual(r_a2.raw_content_cache, "Text2")
+
+    @override_settings(ACCESS_SAMPLE_RATE=1)
+    def test_warm_up_most_accessed_first(self):
+        t1 = Text(text="Rarely read")
+        t1.save()
+        t2 = Text(text="Often read")
+        t2.save()
+        rare = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": t1.pk})
+        popular = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": t2.pk})
+        AssetAccessStatistic.record([rare.pk, popular.pk])
+        AssetAccessStatistic.record([popular.pk])
+        call_command("build_caches", "--warm-up", "--count-budget", "1")
+        self.assertIsNone(Asset.objects.get(pk=rare.pk).content_cache)
+        self.assertIsNone(Asset.objects.get(pk=rare.pk).raw_content_cache)
+        self.assertEqual(Asset.objects.get(pk=popular.pk).content_cache, {
+            "id": str(popular.pk),
+            "type": "span-regular",
+            "text": "Often read"
+        })
+        self.assertEqual(Asset.objects.get(pk=popular.pk).raw_content_cache, "Often read")
+
+    def test_type_filter_and_limit(self):
+        spans = []
+        for i in range(3):
+            t = Text(text="Span %d" % i)
+            t.save()
+            spans.append(Asset.produce(t=AssetType.objects.get(type_name="span-regular"),
+                                       content_ids={"text": t.pk}))
+        t = Text(text="Emphasized")
+        t.save()
+        emphasized = Asset.produce(t=AssetType.objects.get(type_name="span-emphasized"),
+                                   content_ids={"text": t.pk})
+        call_command("build_caches", "--type", "span-regular", "--limit", "2", "--batch-size", "1")
+        self.assertEqual(Asset.objects.filter(pk__in=[span.pk for span in spans],
+                                              content_cache__isnull=False).count(), 2)
+        self.assertIsNone(Asset.objects.get(pk=emphasized.pk).content_cache)
+        self.assertEqual(CacheBuildCheckpoint.objects.count(), 1)
+        call_command("build_caches", "--type", "span-regular", "--resume")
+        self.assertEqual(Asset.objects.filter(pk__in=[span.pk for span in spans],
+                                              content_cache__isnull=False).count(), 3)
+        self.assertIsNone(Asset.objects.get(pk=emphasized.pk).content_cache)
+        self.assertEqual(CacheBuildCheckpoint.objects.count(), 0)
+
+    def test_prerender_templates(self):
+        t = Text(text="Foo")
+        t.save()
+        span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": t.pk})
+        paragraph = Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"),
+                                  content_ids={"spans": [str(span.pk)]})
+        call_command("build_caches", "--templates", "markdown", "proof_html")
+        self.assertEqual(RenderedTemplate.objects.count(), 4)
+        stored = RenderedTemplate.objects.get(asset=paragraph, template_key="proof_html")
+        self.assertEqual(stored.content, "<p>Foo</p>")
+        self.assertEqual(stored.versions, {str(span.pk): 0})
+        self.assertEqual(RenderedTemplate.objects.get(asset=span, template_key="markdown").content, "Foo")
+        self.assertFalse(RenderedTemplate.objects.filter(template_key="sy_xml").exists())
+        Asset.objects.get(pk=span.pk).invalidate()
+        self.assertFalse(RenderedTemplate.objects.filter(asset=span).exists())
+        self.assertEqual(Asset.objects.get(pk=paragraph.pk).render_template("proof_html"), "<p>Foo</p>")
+        self.assertEqual(RenderedTemplate.objects.get(asset=paragraph, template_key="proof_html").versions,
+                         {str(span.pk): 1})
+
+
+class TestProcessInvalidations(TestCase):
+    fixtures = [
+        'span_assets.yaml',
+        'caption-span_assets.yaml',
+        'block_assets.yaml',
+        'table.yaml',
+        'enum_types.yaml'
+    ]
+
+    def test_rebuild_containing_assets(self):
+        t = Text(text="Changed")
+        t.save()
+        span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": t.pk})
+        paragraph = Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"),
+                                  content_ids={"spans": [str(span.pk)]})
+        call_command("build_caches")
+        span = Asset.objects.get(pk=span.pk)
+        span.invalidate()
+        self.assertEqual(CacheInvalidation.objects.count(), 1)
+        self.assertIsNone(Asset.objects.get(pk=span.pk).content_cache)
+        self.assertFalse(Asset.objects.get(pk=paragraph.pk).raw_content_cache_is_fresh())
+        call_command("process_invalidations", "--once")
+        self.assertEqual(CacheInvalidation.objects.count(), 0)
+        self.assertTrue(Asset.objects.get(pk=span.pk).content_cache_is_fresh())
+        self.assertTrue(Asset.objects.get(pk=paragraph.pk).content_cache_is_fresh())
+        self.assertTrue(Asset.objects.get(pk=paragraph.pk).raw_content_cache_is_fresh())
+
+
+class TestCompactChanges(TestCase):
+    fixtures = [
+        'span_assets.yaml',
+        'block_assets.yaml'
+    ]
+
+    def test_squash_old_changes(self):
+        paragraph = Asset(t=AssetType.objects.get(type_name="block-paragraph"))
+        paragraph.save()
+        s1, s2, s3 = str(uuid.uuid4()), str(uuid.uuid4()), str(uuid.uuid4())
+        now = timezone.now()
+        changes = []
+        for days, position, delete, inserts in [(200, 0, 0, [s1]), (150, 1, 0, [s2]), (100, 0, 1, []),
+                                                (1, 1, 0, [s3]), (0, 0, 0, [s1])]:
+            changes.append(AssetChange(time=now - timedelta(days=days), asset=paragraph,
+                                       parent=changes[-1] if len(changes) > 0 else None, key="spans",
+                                       position=position, delete=delete, inserts=inserts))
+            changes[-1].save()
+        self.assertEqual(changes[-1].structure, {"spans": [s1, s2, s3]})
+        call_command("compact_changes", "--older-than", "30")
+        self.assertEqual(AssetChange.objects.filter(asset=paragraph).count(), 3)
+        base = AssetChange.objects.get(pk=changes[2].pk)
+        self.assertTrue(base.squashed)
+        self.assertIsNone(base.parent)
+        self.assertEqual(base.structure_cache, {"spans": [s2]})
+        self.assertIsNone(AssetChange.objects.get(pk=changes[3].pk).structure_cache)
+        self.assertEqual(AssetChange.objects.get(pk=changes[4].pk).structure_cache, {"spans": [s1, s2, s3]})
+        head = AssetChange.objects.get(pk=changes[4].pk)
+        head.structure_cache = None
+        self.assertEqual(head.structure, {"spans": [s1, s2, s3]})
+
+
+class TestCollectGarbage(TestCase):
+    fixtures = [
+        'span_assets.yaml'
+    ]
+
+    def test_mark_and_sweep(self):
+        used_text = Text(text="Used")
+        used_text.save()
+        orphaned_text = Text(text="Orphaned")
+        orphaned_text.save()
+        revived_text = Text(text="Revived")
+        revived_text.save()
+        span_type = AssetType.objects.get(type_name="span-regular")
+        previous_revision = Asset(t=span_type)
+        previous_revision.save()
+        empty_asset = Asset(t=span_type)
+        empty_asset.save()
+        detached_copy = Asset(t=span_type)
+        detached_copy.save()
+        detached_copy.record_revision_snapshot({"text": used_text.pk})
+        span = Asset.produce(t=span_type, content_ids={"text": used_text.pk})
+        span.revision_chain = previous_revision
+        span.save()
+        call_command("collect_garbage", "--batch-size", "2")
+        self.assertTrue(GarbageMark.objects.filter(kind="text", object_id=str(orphaned_text.pk)).exists())
+        self.assertTrue(GarbageMark.objects.filter(kind="text", object_id=str(revived_text.pk)).exists())
+        self.assertTrue(GarbageMark.objects.filter(kind="asset", object_id=str(empty_asset.pk)).exists())
+        self.assertFalse(GarbageMark.objects.filter(kind="text", object_id=str(used_text.pk)).exists())
+        self.assertFalse(GarbageMark.objects.filter(kind="asset", object_id=str(span.pk)).exists())
+        self.assertFalse(GarbageMark.objects.filter(kind="asset", object_id=str(previous_revision.pk)).exists())
+        self.assertFalse(GarbageMark.objects.filter(kind="asset", object_id=str(detached_copy.pk)).exists())
+        self.assertTrue(Text.objects.filter(pk=orphaned_text.pk).exists())
+        span.text_reference_list.append(revived_text.pk)
+        span.save()
+        call_command("collect_garbage", "--grace", "0")
+        self.assertFalse(Text.objects.filter(pk=orphaned_text.pk).exists())
+        self.assertFalse(Asset.objects.filter(pk=empty_asset.pk).exists())
+        self.assertTrue(Text.objects.filter(pk=revived_text.pk).exists())
+        self.assertTrue(Text.objects.filter(pk=used_text.pk).exists())
+        self.assertTrue(Asset.objects.filter(pk=previous_revision.pk).exists())
+        self.assertTrue(Asset.objects.filter(pk=detached_copy.pk).exists())
+        self.assertFalse(GarbageMark.objects.filter(kind="text", object_id=str(revived_text.pk)).exists())
+
+
+class TestImportAssets(TestCase):
+    fixtures = [
+        'span_assets.yaml',
+        'block_assets.yaml'
+    ]
+
+    def write_ndjson(self, lines):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "assets.ndjson")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_import(self):
+        existing_text = Text(text="Existing")
+        existing_text.save()
+        existing_span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"),
+                                      content_ids={"text": existing_text.pk})
+        paragraph = {"type": "block-paragraph", "spans": [
+            {"type": "span-regular", "text": "Tab\tand\nnewline with \\ backslash"},
+            {"id": str(existing_span.pk)},
+            {"type": "span-emphasized", "text": "Emphasized"}]}
+        path = self.write_ndjson([
+            json.dumps(paragraph),
+            "",
+            json.dumps({"type": "span-regular", "text": "Single span"})])
+        call_command("import_assets", path, "--batch-size", "1")
+        self.assertEqual(Asset.objects.count(), 5)
+        imported = Asset.objects.filter(t__type_name="block-paragraph").get()
+        self.assertEqual(imported.content["spans"][0]["text"], "Tab\tand\nnewline with \\ backslash")
+        self.assertEqual(imported.content["spans"][1]["id"], str(existing_span.pk))
+        self.assertEqual(imported.content["spans"][2]["text"], "Emphasized")
+        self.assertEqual(AssetChange.objects.filter(asset=imported).count(), 1)
+        self.assertTrue(Text.objects.filter(text="Single span").exists())
+
+    def test_invalid_lines(self):
+        path = self.write_ndjson([
+            json.dumps({"type": "span-regular", "text": "Valid"}),
+            json.dumps({"type": "span-regular", "text": 42}),
+            "not json"])
+        with self.assertRaises(CommandError):
+            call_command("import_assets", path)
+        self.assertEqual(Asset.objects.count(), 0)
+        call_command("import_assets", path, "--skip-invalid")
+        self.assertEqual(Asset.objects.count(), 1)
+        self.assertEqual(Asset.objects.get().content["text"], "Valid")
+
+    def test_skip_modification_without_orphans(self):
+        existing_text = Text(text="Existing")
+        existing_text.save()
+        existing_span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"),
+                                      content_ids={"text": existing_text.pk})
+        path = self.write_ndjson([
+            json.dumps({"type": "block-paragraph", "spans": [
+                {"type": "span-regular", "text": "Sibling before the modification"},
+                {"id": str(existing_span.pk), "type": "span-regular", "text": "Modified"}]}),
+            json.dumps({"type": "span-regular", "text": "Valid"})])
+        call_command("import_assets", path, "--skip-invalid")
+        self.assertEqual(Asset.objects.count(), 2)
+        self.assertFalse(Text.objects.filter(text="Sibling before the modification").exists())
+        self.assertFalse(Text.objects.filter(text="Modified").exists())
+        self.assertTrue(Text.objects.filter(text="Valid").exists())
+
+
+class TestParallelBuildCaches(TransactionTestCase):
+    fixtures = [
+        'span_assets.yaml',
+        'caption-span_assets.yaml',
+        'block_assets.yaml',
+        'table.yaml',
+        'enum_types.yaml'
+    ]
+
+    def test_workers(self):
+        spans = []
+        for i in range(10):
+            t = Text(text="Span %d" % i)
+            t.save()
+            spans.append(Asset.produce(t=AssetType.objects.get(type_name="span-regular"),
+                                       content_ids={"text": t.pk}))
+        paragraph = Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"),
+                                  content_ids={"spans": [str(span.pk) for span in spans]})
+        call_command("build_caches", "--workers", "3")
+        for span in spans:
+            self.assertIsNotNone(Asset.objects.get(pk=span.pk).content_cache)
+            self.assertIsNotNone(Asset.objects.get(pk=span.pk).raw_content_cache)
+        self.assertEqual(Asset.objects.get(pk=paragraph.pk).raw_content_cache,
+                         "".join("Span %d" % i for i in range(10)) + "\n\n")
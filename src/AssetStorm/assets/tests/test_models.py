@@ -193,11 +193,68 @@ class AssetBasicTestCase(TestCase):
         block = Asset.objects.get(pk=block.pk)
         self.assertIsNotNone(span.content_cache)
         self.assertIsNotNone(block.content_cache)
+        self.assertTrue(block.content_cache_is_fresh())
+        self.assertEqual(block.content_cache_versions, {str(span.pk): 0})
         span.clear_cache()
         span = Asset.objects.get(pk=span.pk)
         block = Asset.objects.get(pk=block.pk)
         self.assertIsNone(span.content_cache)
-        self.assertIsNone(block.content_cache)
+        self.assertEqual(span.version, 1)
+        self.assertIsNotNone(block.content_cache)
+        self.assertFalse(block.content_cache_is_fresh())
+        self.assertEqual(block.content["spans"][0]["text"], "cached text")
+        block = Asset.objects.get(pk=block.pk)
+        self.assertEqual(block.content_cache_versions, {str(span.pk): 1})
+        self.assertTrue(block.content_cache_is_fresh())
+
+    def test_serialized_content_cache(self):
+        text = Text(text="serialized span")
+        text.save()
+        span = Asset.produce(t=self.at("span-regular"), content_ids={"text": text.pk})
+        block = Asset.produce(t=self.at("block-paragraph"), content_ids={"spans": [str(span.pk)]})
+        self.assertIsNone(block.serialized_content_cache)
+        serialized_contents = Asset.load_serialized_contents([block.pk, span.pk])
+        self.assertEqual(set(serialized_contents.keys()), {block.pk, span.pk})
+        self.assertEqual(serialized_contents[block.pk][1], {str(span.pk): 0})
+        self.assertJSONEqual(str(serialized_contents[block.pk][0], encoding="utf-8"), json.dumps({
+            'type': "block-paragraph",
+            'id': str(block.pk),
+            'spans': [
+                {'type': "span-regular",
+                 'id': str(span.pk),
+                 'text': "serialized span"}
+            ]
+        }))
+        block = Asset.objects.get(pk=block.pk)
+        self.assertEqual(bytes(block.serialized_content_cache), serialized_contents[block.pk][0])
+        block.clear_cache()
+        self.assertIsNone(Asset.objects.get(pk=block.pk).serialized_content_cache)
+
+    def test_reset_keeps_concurrent_version_bumps(self):
+        text = Text(text="leaf")
+        text.save()
+        span = Asset.produce(t=self.at("span-regular"), content_ids={"text": text.pk})
+        stale_span = Asset.objects.get(pk=span.pk)
+        Asset.objects.get(pk=span.pk).invalidate()
+        self.assertEqual(Asset.objects.get(pk=span.pk).version, 1)
+        stale_span.invalidate()
+        self.assertEqual(stale_span.version, 2)
+        self.assertEqual(Asset.objects.get(pk=span.pk).version, 2)
+
+    def test_dependency_levels(self):
+        text = Text(text="leaf")
+        text.save()
+        span = Asset.produce(t=self.at("span-regular"), content_ids={"text": text.pk})
+        other_span = Asset.produce(t=self.at("span-regular"), content_ids={"text": text.pk})
+        block = Asset.produce(t=self.at("block-paragraph"), content_ids={"spans": [str(span.pk)]})
+        box = Asset.produce(t=self.at("block-info-box"), content_ids={
+            "title": text.pk,
+            "content": [str(block.pk)]})
+        levels = Asset.dependency_levels([box.pk, block.pk, span.pk, other_span.pk])
+        self.assertEqual(len(levels), 3)
+        self.assertEqual(set(levels[0]), {span.pk, other_span.pk})
+        self.assertEqual(levels[1:], [[block.pk], [box.pk]])
+        self.assertEqual(Asset.dependency_levels([box.pk, span.pk]), [[box.pk, span.pk]])
 
     def test_reference_lists(self):
         text = Text(text="text in span and a ")
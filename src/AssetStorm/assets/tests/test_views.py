@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test import Client
+from django.test import override_settings
 from django.urls import reverse
 from django.core.management import call_command
+from django.utils import timezone
+from django.db.models import F
 from unittest.mock import patch
-from AssetStorm.assets.models import AssetType, Asset, Text, UriElement, Enum, EnumType
+from AssetStorm.assets.models import AssetType, Asset, Text, UriElement, Enum, EnumType, AssetAccessStatistic
+from AssetStorm.assets.models import CacheRebuildJob, AssetChange
+from AssetStorm.assets.views import find_result_cache, get_fresh_cached_contents
+from AssetStorm.assets.caches import asset_cache, asset_cache_key
 from AssetStorm.urls import urlpatterns
+from datetime import timedelta
 import json
 import os
 
@@ -71,6 +78,360 @@ class TestLoadAsset(TestCase):
             ]
         })
 
+    def test_load_with_depth(self):
+        title = Text(text="Text Box Title")
+        title.save()
+        content = Text(text="This is the content of the box.")
+        content.save()
+        span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={
+            "text": content.pk
+        })
+        paragraph_block = Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"), content_ids={
+            "spans": [str(span.pk)]
+        })
+        box = Asset.produce(t=AssetType.objects.get(type_name="block-accompaniement-box"), content_ids={
+            "title": title.pk,
+            "content": [str(paragraph_block.pk)]})
+        expected_content = {
+            "type": "block-accompaniement-box",
+            "title": "Text Box Title",
+            "id": str(box.pk),
+            "content": [
+                {"type": "block-paragraph",
+                 "id": str(paragraph_block.pk),
+                 "spans": [
+                     {"type": "span-regular",
+                      "id": str(span.pk)}
+                 ]}
+            ]
+        }
+        response = self.client.get(reverse('load_asset'), {"id": str(box.pk), "depth": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content, expected_content)
+        self.assertIsNone(Asset.objects.get(pk=box.pk).content_cache)
+        box.content
+        response = self.client.get(reverse('load_asset'), {"id": str(box.pk), "depth": 1})
+        self.assertJSONEqual(response.content, expected_content)
+        response = self.client.get(reverse('load_asset'), {"id": str(box.pk), "depth": 0})
+        self.assertJSONEqual(response.content, {
+            "type": "block-accompaniement-box",
+            "title": "Text Box Title",
+            "id": str(box.pk),
+            "content": [{"type": "block-paragraph", "id": str(paragraph_block.pk)}]
+        })
+
+    def test_load_from_asset_cache(self):
+        text = Text(text="Hot asset")
+        text.save()
+        span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": text.pk})
+        response = self.client.get(reverse('load_asset'), {"id": str(span.pk)})
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1), override_settings(ACCESS_SAMPLE_RATE=0):
+            cached_response = self.client.get(reverse('load_asset'), {"id": str(span.pk)})
+        self.assertEqual(response.content, cached_response.content)
+        self.assertIsNotNone(asset_cache().get(asset_cache_key(span.pk)))
+        Asset.objects.filter(pk=span.pk).update(version=F("version") + 1)
+        self.assertEqual(get_fresh_cached_contents([span.pk]), {})
+        Asset.objects.get(pk=span.pk).clear_cache()
+        self.assertIsNone(asset_cache().get(asset_cache_key(span.pk)))
+
+    def test_serve_stale_content_while_rebuilding(self):
+        text = Text(text="Popular asset")
+        text.save()
+        span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": text.pk})
+        response = self.client.get(reverse('load_asset'), {"id": str(span.pk)})
+        Asset.objects.get(pk=span.pk).clear_cache()
+        with patch('AssetStorm.assets.locks.try_advisory_lock', lambda key: False), \
+                override_settings(STAMPEDE_WAIT=0):
+            stale_response = self.client.get(reverse('load_asset'), {"id": str(span.pk)})
+        self.assertEqual(stale_response.status_code, 200)
+        self.assertEqual(response.content, stale_response.content)
+        self.assertIsNone(Asset.objects.get(pk=span.pk).content_cache)
+
+    def test_serve_stale_content_after_save(self):
+        save_response = self.client.post(reverse("save_asset"), data={
+            "type": "span-regular",
+            "text": "Before the edit"
+        }, content_type="application/json")
+        span_id = json.loads(save_response.content)["id"]
+        response = self.client.get(reverse('load_asset'), {"id": span_id})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("save_asset"), data={
+                "id": span_id,
+                "type": "span-regular",
+                "text": "After the edit"
+            }, content_type="application/json")
+        with patch('AssetStorm.assets.locks.try_advisory_lock', lambda key: False), \
+                override_settings(STAMPEDE_WAIT=0):
+            stale_response = self.client.get(reverse('load_asset'), {"id": span_id})
+        self.assertEqual(stale_response.status_code, 200)
+        self.assertEqual(response.content, stale_response.content)
+        fresh_response = self.client.get(reverse('load_asset'), {"id": span_id})
+        self.assertEqual(json.loads(fresh_response.content)["text"], "After the edit")
+
+    @override_settings(ACCESS_SAMPLE_RATE=1)
+    def test_access_statistics(self):
+        text = Text(text="Counted asset")
+        text.save()
+        span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": text.pk})
+        self.client.get(reverse('load_asset'), {"id": str(span.pk)})
+        self.client.get(reverse('load_asset'), {"id": str(span.pk)})
+        self.client.get(reverse('load_many_assets'), {"id": [str(span.pk)]})
+        self.assertEqual(AssetAccessStatistic.objects.get(asset=span).access_count, 3)
+
+    def test_invalid_depth(self):
+        response = self.client.get(reverse('load_asset'),
+                                   {"id": "cd1249e5-3955-4468-87be-d912e1adb2d9", "depth": "deep"})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {
+            'Error': "The depth must be a non-negative integer."
+        })
+
+    def test_load_at_time(self):
+        now = timezone.now()
+        old_text = Text(text="Old")
+        old_text.save()
+        new_text = Text(text="New")
+        new_text.save()
+        span = Asset(t=AssetType.objects.get(type_name="span-regular"))
+        span.save()
+        first = AssetChange(time=now - timedelta(days=10), asset=span, key="text", inserts=old_text.pk)
+        first.save()
+        AssetChange(time=now - timedelta(days=2), asset=span, parent=first, key="text", inserts=new_text.pk).save()
+        paragraph = Asset(t=AssetType.objects.get(type_name="block-paragraph"))
+        paragraph.save()
+        AssetChange(time=now - timedelta(days=5), asset=paragraph, key="spans", inserts=[str(span.pk)]).save()
+        response = self.client.get(reverse('load_asset'), {
+            "id": str(paragraph.pk), "at": (now - timedelta(days=3)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content, {
+            "type": "block-paragraph", "id": str(paragraph.pk),
+            "spans": [{"type": "span-regular", "id": str(span.pk), "text": "Old"}]})
+        response = self.client.get(reverse('load_asset'), {
+            "id": str(paragraph.pk), "at": now.isoformat(), "depth": 0})
+        self.assertJSONEqual(response.content, {
+            "type": "block-paragraph", "id": str(paragraph.pk),
+            "spans": [{"type": "span-regular", "id": str(span.pk)}]})
+        response = self.client.get(reverse('load_asset'), {"id": str(span.pk), "at": now.isoformat()})
+        self.assertJSONEqual(response.content, {"type": "span-regular", "id": str(span.pk), "text": "New"})
+        response = self.client.get(reverse('load_asset'), {
+            "id": str(paragraph.pk), "at": (now - timedelta(days=7)).isoformat()})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(Asset.objects.get(pk=paragraph.pk).content_cache)
+
+    def test_invalid_time(self):
+        response = self.client.get(reverse('load_asset'),
+                                   {"id": "cd1249e5-3955-4468-87be-d912e1adb2d9", "at": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {
+            'Error': "The time 'at' must be an ISO 8601 datetime like 2020-04-01T12:00:00+02:00."
+        })
+        response = self.client.get(reverse('load_asset'),
+                                   {"id": "cd1249e5-3955-4468-87be-d912e1adb2d9", "at": "2020-13-01T00:00:00"})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {
+            'Error': "The time 'at' must be an ISO 8601 datetime like 2020-04-01T12:00:00+02:00."
+        })
+
+
+class TestLoadManyAssets(TestCase):
+    fixtures = [
+        'span_assets.yaml',
+        'caption-span_assets.yaml',
+        'block_assets.yaml',
+        'table.yaml',
+        'enum_types.yaml'
+    ]
+
+    def setUp(self) -> None:
+        self.client = Client()
+
+    def test_no_params(self):
+        response = self.client.get(reverse('load_many_assets'))
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {
+            'Error': "Please supply at least one 'id' as a GET param."
+        })
+
+    def test_invalid_id(self):
+        response = self.client.get(reverse('load_many_assets'), {"id": ["no-uuid"]})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {
+            'Error': "The id 'no-uuid' is not a valid uuid (v4)."
+        })
+
+    def test_load_warm_and_cold_assets(self):
+        t1 = Text(text="Foo")
+        t1.save()
+        t2 = Text(text="Bar")
+        t2.save()
+        warm_span = Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": t1.pk})
+        warm_span.content
+        cold_span = Asset.produce(t=AssetType.objects.get(type_name="span-emphasized"), content_ids={"text": t2.pk})
+        paragraph = Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"), content_ids={
+            "spans": [str(warm_span.pk), str(cold_span.pk)]})
+        response = self.client.get(reverse('load_many_assets'), {"id": [str(paragraph.pk), str(warm_span.pk)]})
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content, [
+            {"type": "block-paragraph",
+             "id": str(paragraph.pk),
+             "spans": [
+                 {"type": "span-regular", "id": str(warm_span.pk), "text": "Foo"},
+                 {"type": "span-emphasized", "id": str(cold_span.pk), "text": "Bar"}
+             ]},
+            {"type": "span-regular", "id": str(warm_span.pk), "text": "Foo"}
+        ])
+        paragraph = Asset.objects.get(pk=paragraph.pk)
+        self.assertIsNotNone(paragraph.content_cache)
+        self.assertEqual(paragraph.asset_reference_list, [warm_span.pk, cold_span.pk])
+        self.assertIsNotNone(Asset.objects.get(pk=cold_span.pk).content_cache)
+
+
+class TestLoadHistory(TestCase):
+    fixtures = [
+        'span_assets.yaml'
+    ]
+
+    def setUp(self) -> None:
+        self.client = Client()
+        span_type = AssetType.objects.get(type_name="span-regular")
+        self.oldest = Asset.objects.create(t=span_type, content_cache={"type": "span-regular", "text": "Oldest"})
+        self.middle = Asset.objects.create(t=span_type, content_cache={"type": "span-regular", "text": "Middle"},
+                                           revision_chain=self.oldest)
+        t = Text(text="Current")
+        t.save()
+        self.current = Asset.produce(t=span_type, content_ids={"text": t.pk})
+        self.current.revision_chain = self.middle
+        self.current.save()
+
+    def test_whole_chain(self):
+        response = self.client.get(reverse('load_history'), {"id": str(self.current.pk)})
+        self.assertEqual(response.status_code, 200)
+        history = json.loads(response.content)
+        self.assertFalse(history["has_more"])
+        self.assertEqual([revision["id"] for revision in history["revisions"]],
+                         [str(self.current.pk), str(self.middle.pk), str(self.oldest.pk)])
+        self.assertEqual([revision["revision"] for revision in history["revisions"]], [0, 1, 2])
+        self.assertEqual(history["revisions"][0]["previous_id"], str(self.middle.pk))
+        self.assertIsNone(history["revisions"][2]["previous_id"])
+        self.assertEqual(history["revisions"][0]["type"], "span-regular")
+        self.assertIsNotNone(history["revisions"][0]["changed"])
+        self.assertNotIn("content", history["revisions"][0])
+
+    def test_pagination_with_content(self):
+        response = self.client.get(reverse('load_history'), {
+            "id": str(self.current.pk), "offset": 1, "limit": 1, "content": "true"})
+        self.assertEqual(response.status_code, 200)
+        history = json.loads(response.content)
+        self.assertTrue(history["has_more"])
+        self.assertEqual(len(history["revisions"]), 1)
+        self.assertEqual(history["revisions"][0]["id"], str(self.middle.pk))
+        self.assertEqual(history["revisions"][0]["content"], {"type": "span-regular", "text": "Middle"})
+        response = self.client.get(reverse('load_history'), {
+            "id": str(self.current.pk), "limit": 1, "content": "true"})
+        self.assertEqual(json.loads(response.content)["revisions"][0]["content"], {
+            "type": "span-regular", "id": str(self.current.pk), "text": "Current"})
+
+    def test_unknown_asset(self):
+        response = self.client.get(reverse('load_history'), {"id": "a1f4e3b9-7f10-4d4f-9c1f-5d0f2b8a6c11"})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {
+            'Error': "No Asset with id=a1f4e3b9-7f10-4d4f-9c1f-5d0f2b8a6c11 found."
+        })
+
+    def test_invalid_limit(self):
+        response = self.client.get(reverse('load_history'), {"id": str(self.current.pk), "limit": 0})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestDiffRevisions(TestCase):
+    fixtures = [
+        'span_assets.yaml',
+        'block_assets.yaml'
+    ]
+
+    def setUp(self) -> None:
+        self.client = Client()
+
+    def test_diff_at_times(self):
+        now = timezone.now()
+        old_text = Text(text="Der schnelle Fuchs")
+        old_text.save()
+        new_text = Text(text="Der langsame Fuchs")
+        new_text.save()
+        span = Asset(t=AssetType.objects.get(type_name="span-regular"))
+        span.save()
+        first = AssetChange(time=now - timedelta(days=10), asset=span, key="text", inserts=old_text.pk)
+        first.save()
+        AssetChange(time=now - timedelta(days=2), asset=span, parent=first, key="text", inserts=new_text.pk).save()
+        response = self.client.get(reverse('diff_revisions'), {
+            "id": str(span.pk),
+            "from": (now - timedelta(days=5)).isoformat(),
+            "to": now.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["operations"], [{
+            "key": "text", "op": "replace", "position": 0,
+            "from": [old_text.pk], "to": [new_text.pk],
+            "from_values": ["Der schnelle Fuchs"], "to_values": ["Der langsame Fuchs"],
+            "text_diffs": [[{"op": "replace", "position": 4, "from": "schnelle", "to": "langsame"}]]
+        }])
+
+    def test_diff_revisions(self):
+        texts = []
+        for text in ["Foo", "Bar", "Baz"]:
+            texts.append(Text(text=text))
+            texts[-1].save()
+        spans = [Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": t.pk})
+                 for t in texts]
+        old_paragraph = Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"),
+                                      content_ids={"spans": [str(spans[0].pk), str(spans[1].pk)]})
+        new_paragraph = Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"),
+                                      content_ids={"spans": [str(spans[0].pk), str(spans[2].pk)]})
+        response = self.client.get(reverse('diff_revisions'), {
+            "from": str(old_paragraph.pk), "to": str(new_paragraph.pk)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["operations"], [{
+            "key": "spans", "op": "replace", "position": 1,
+            "from": [str(spans[1].pk)], "to": [str(spans[2].pk)]
+        }])
+
+    def test_diff_previous_revision(self):
+        save_response = self.client.post(reverse("save_asset"), data={
+            "type": "span-regular",
+            "text": "Foo bar"
+        }, content_type="application/json")
+        span_id = json.loads(save_response.content)["id"]
+        self.client.post(reverse("save_asset"), data={
+            "id": span_id,
+            "type": "span-regular",
+            "text": "Foo baz"
+        }, content_type="application/json")
+        previous_id = str(Asset.objects.get(pk=span_id).revision_chain_id)
+        history = json.loads(self.client.get(reverse('load_history'), {"id": span_id}).content)
+        self.assertEqual(history["revisions"][1]["id"], previous_id)
+        response = self.client.get(reverse('diff_revisions'), {"from": previous_id, "to": span_id})
+        self.assertEqual(response.status_code, 200)
+        operations = json.loads(response.content)["operations"]
+        self.assertEqual(len(operations), 1)
+        self.assertEqual(operations[0]["key"], "text")
+        self.assertEqual(operations[0]["from_values"], ["Foo bar"])
+        self.assertEqual(operations[0]["to_values"], ["Foo baz"])
+
+    def test_invalid_times(self):
+        span = Asset(t=AssetType.objects.get(type_name="span-regular"))
+        span.save()
+        response = self.client.get(reverse('diff_revisions'), {
+            "id": str(span.pk), "from": "2020-13-01T00:00:00", "to": "2020-04-01T00:00:00"})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {
+            'Error': "With an 'id' the params 'from' and 'to' must be ISO 8601 datetimes."
+        })
+
+    def test_missing_params(self):
+        response = self.client.get(reverse('diff_revisions'), {"from": "a"})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {'Error': "Please supply 'from' and 'to' as GET params."})
+
 
 class TestSaveAsset(TestCase):
     fixtures = [
@@ -725,6 +1086,7 @@ class TestQueryView(TestCase):
 
     def setUp(self) -> None:
         self.client = Client()
+        find_result_cache.clear()
 
     def test_filter_not_json(self):
         response = self.client.post(
@@ -823,6 +1185,143 @@ class TestQueryView(TestCase):
             "raw_content_snippet": box.raw_content_cache[:500]
         }, found_assets)
 
+    def test_find_ids_only(self):
+        save_response = self.client.post(reverse("save_asset"), data={
+            "type": "block-info-box",
+            "title": "Box from test",
+            "content": [
+                {"type": "block-paragraph",
+                 "spans": [
+                     {"type": "span-regular",
+                      "text": "This is the text "},
+                     {"type": "span-strong",
+                      "text": "you"},
+                     {"type": "span-regular",
+                      "text": " are searching for!"}
+                 ]}
+            ]
+        }, content_type="application/json")
+        call_command("build_caches")
+        find_response = self.client.post(
+            reverse("find_assets", args=("text you",)) + "?fields=id",
+            data={
+                "type": "block-info-box"
+            }, content_type="application/json")
+        self.assertEqual(find_response.status_code, 200)
+        self.assertEqual(json.loads(find_response.content), {
+            "assets": [{"id": json.loads(save_response.content)["id"]}]
+        })
+
+    def test_find_type_counts(self):
+        self.client.post(reverse("save_asset"), data={
+            "type": "block-info-box",
+            "title": "Box from test",
+            "content": [
+                {"type": "block-paragraph",
+                 "spans": [
+                     {"type": "span-regular",
+                      "text": "This is the text "},
+                     {"type": "span-strong",
+                      "text": "you"},
+                     {"type": "span-regular",
+                      "text": " are searching for!"}
+                 ]}
+            ]
+        }, content_type="application/json")
+        call_command("build_caches")
+        find_response = self.client.post(
+            reverse("find_assets", args=("text",)) + "?fields=id&type_counts=true",
+            data=None, content_type="application/json")
+        self.assertEqual(find_response.status_code, 200)
+        self.assertEqual(json.loads(find_response.content)["type_counts"], {
+            "block-info-box": 1,
+            "block-paragraph": 1,
+            "span-regular": 1
+        })
+        self.assertEqual(len(json.loads(find_response.content)["assets"]), 3)
+
+    def test_find_result_cache(self):
+        box_tree = {
+            "type": "block-info-box",
+            "title": "Box from test",
+            "content": [
+                {"type": "block-paragraph",
+                 "spans": [
+                     {"type": "span-regular",
+                      "text": "cached search"}
+                 ]}
+            ]
+        }
+        self.client.post(reverse("save_asset"), data=box_tree, content_type="application/json")
+        call_command("build_caches")
+        find_response = self.client.post(
+            reverse("find_assets", args=("cached search",)) + "?fields=id",
+            data={"type": "block-info-box"}, content_type="application/json")
+        self.assertEqual(len(json.loads(find_response.content)["assets"]), 1)
+        with self.assertNumQueries(1), override_settings(ACCESS_SAMPLE_RATE=0):
+            cached_response = self.client.post(
+                reverse("find_assets", args=("cached search",)) + "?fields=id",
+                data={"type": "block-info-box"}, content_type="application/json")
+        self.assertEqual(find_response.content, cached_response.content)
+        self.client.post(reverse("save_asset"), data=box_tree, content_type="application/json")
+        call_command("build_caches")
+        find_response = self.client.post(
+            reverse("find_assets", args=("cached search",)) + "?fields=id",
+            data={"type": "block-info-box"}, content_type="application/json")
+        self.assertEqual(len(json.loads(find_response.content)["assets"]), 2)
+
+    def test_find_skips_outdated_caches(self):
+        save_response = self.client.post(reverse("save_asset"), data={
+            "type": "block-info-box",
+            "title": "Box from test",
+            "content": [
+                {"type": "block-paragraph",
+                 "spans": [
+                     {"type": "span-regular",
+                      "text": "old words"}
+                 ]}
+            ]
+        }, content_type="application/json")
+        call_command("build_caches")
+        box = Asset.objects.get(pk=json.loads(save_response.content)["id"])
+        span_id = box.content["content"][0]["spans"][0]["id"]
+        self.client.post(reverse("save_asset"), data={
+            "id": span_id,
+            "type": "span-regular",
+            "text": "new words"
+        }, content_type="application/json")
+        find_response = self.client.post(
+            reverse("find_assets", args=("old words",)) + "?fields=id",
+            data=None, content_type="application/json")
+        self.assertEqual(json.loads(find_response.content), {"assets": []})
+        call_command("build_caches")
+        find_response = self.client.post(
+            reverse("find_assets", args=("new words",)) + "?fields=id",
+            data=None, content_type="application/json")
+        self.assertEqual(len(json.loads(find_response.content)["assets"]), 3)
+
+    @override_settings(ACCESS_SAMPLE_RATE=1)
+    def test_find_result_cache_counts_accesses(self):
+        save_response = self.client.post(reverse("save_asset"), data={
+            "type": "span-regular",
+            "text": "counted search"
+        }, content_type="application/json")
+        call_command("build_caches")
+        for _ in range(3):
+            self.client.post(reverse("find_assets", args=("counted search",)) + "?fields=id",
+                             data=None, content_type="application/json")
+        self.assertEqual(AssetAccessStatistic.objects.get(
+            asset_id=json.loads(save_response.content)["id"]).access_count, 3)
+
+    def test_find_unknown_field(self):
+        response = self.client.post(
+            reverse("filter_assets") + "?fields=id,content_cache",
+            data=None, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content), {
+            "Error": "Unknown field \"content_cache\". Possible fields are: id, type_id, raw_content_snippet."
+        })
+
     def test_find_filter_id_only(self):
         article_tree = {
             "type": "article-standard",
@@ -1013,16 +1512,53 @@ class TestUpdateCachesView(TestCase):
         self.assertIsNone(asset.content_cache)
         self.assertIsNone(asset.raw_content_cache)
         update_cache_response = self.client.get(reverse("update_caches"))
-        self.assertEqual(200, update_cache_response.status_code)
-        self.assertEqual({'Success': True, 'rebuilt_content_caches': 1, 'rendered_raw_templates': 1},
-                         json.loads(str(update_cache_response.content, encoding="utf-8")))
+        self.assertEqual(202, update_cache_response.status_code)
+        job = json.loads(str(update_cache_response.content, encoding="utf-8"))
+        self.assertTrue(job['Success'])
+        self.assertEqual("queued", job['status'])
+        self.assertIsNone(Asset.objects.get(pk=asset_id).content_cache)
+        call_command("run_jobs", "--once")
+        status_response = self.client.get(reverse("job_status", kwargs={"job_id": job['job_id']}))
+        self.assertEqual(200, status_response.status_code)
+        status = json.loads(str(status_response.content, encoding="utf-8"))
+        self.assertEqual("done", status['status'])
+        self.assertEqual(1, status['content_caches_total'])
+        self.assertEqual(1, status['rebuilt_content_caches'])
+        self.assertEqual(1, status['raw_templates_total'])
+        self.assertEqual(1, status['rendered_raw_templates'])
         asset = Asset.objects.get(pk=asset_id)
         self.assertEqual({'type': 'span-regular', 'text': 'foo', 'id': str(asset.pk)}, asset.content_cache)
         self.assertEqual('foo', asset.raw_content_cache)
         update_cache_response = self.client.get(reverse("update_caches"))
-        self.assertEqual(200, update_cache_response.status_code)
-        self.assertEqual({'Success': True, 'rebuilt_content_caches': 0, 'rendered_raw_templates': 0},
-                         json.loads(str(update_cache_response.content, encoding="utf-8")))
+        second_job_id = json.loads(str(update_cache_response.content, encoding="utf-8"))['job_id']
+        self.assertNotEqual(job['job_id'], second_job_id)
+        call_command("run_jobs", "--once")
+        second_job = CacheRebuildJob.objects.get(pk=second_job_id)
+        self.assertEqual(CacheRebuildJob.DONE, second_job.status)
+        self.assertEqual(0, second_job.rebuilt_content_caches)
+        self.assertEqual(0, second_job.rendered_raw_templates)
+        self.assertEqual(0, second_job.content_caches_total)
+        self.assertEqual(0, second_job.raw_templates_total)
+
+    @override_settings(JOB_STALE_AFTER=60)
+    def test_reclaim_stale_job(self):
+        crashed_job = CacheRebuildJob.objects.create(status=CacheRebuildJob.RUNNING,
+                                                     heartbeat=timezone.now() - timedelta(minutes=5))
+        CacheRebuildJob.objects.create(status=CacheRebuildJob.RUNNING, heartbeat=timezone.now())
+        self.assertEqual(crashed_job.pk, CacheRebuildJob.claim().pk)
+        self.assertIsNone(CacheRebuildJob.claim())
+
+    def test_reuse_queued_job(self):
+        first_response = self.client.get(reverse("update_caches"))
+        second_response = self.client.get(reverse("update_caches"))
+        self.assertEqual(json.loads(str(first_response.content, encoding="utf-8"))['job_id'],
+                         json.loads(str(second_response.content, encoding="utf-8"))['job_id'])
+        self.assertEqual(1, CacheRebuildJob.objects.count())
+
+    def test_unknown_job(self):
+        response = self.client.get(reverse("job_status", kwargs={"job_id": "no-uuid"}))
+        self.assertEqual(400, response.status_code)
+        self.assertEqual({"Error": "No job with id=no-uuid found."}, json.loads(response.content))
 
 
 class TestDeliverOpenApiDefinition(TestCase):
@@ -1114,3 +1650,39 @@ class TestDeleteAllAssets(TestCase):
         self.assertEqual(0, Text.objects.all().count())
         self.assertEqual(0, UriElement.objects.all().count())
         self.assertEqual(0, Enum.objects.all().count())
+
+
+class TestFastDeleteAllAssets(TransactionTestCase):
+    fixtures = [
+        'block_assets.yaml',
+        'span_assets.yaml'
+    ]
+
+    def setUp(self) -> None:
+        self.client = Client()
+
+    def test_truncate(self):
+        texts = []
+        for text in ["Foo", "Bar"]:
+            texts.append(Text(text=text))
+            texts[-1].save()
+        spans = [Asset.produce(t=AssetType.objects.get(type_name="span-regular"), content_ids={"text": t.pk})
+                 for t in texts]
+        Asset.produce(t=AssetType.objects.get(type_name="block-paragraph"),
+                      content_ids={"spans": [str(span.pk) for span in spans]})
+        delete_all_response = self.client.delete(reverse("delete_all_assets") + "?fast=true")
+        self.assertEqual(200, delete_all_response.status_code)
+        self.assertEqual({
+            'Asset': 6,
+            'Asset_in_detail': {'assets.Asset': 3, 'assets.AssetChange': 3},
+            'Enum': 0,
+            'Enum_in_detail': {'assets.Enum': 0},
+            'Text': 2,
+            'Text_in_detail': {'assets.Text': 2},
+            'UriElement': 0,
+            'UriElement_in_detail': {'assets.UriElement': 0}},
+            json.loads(str(delete_all_response.content, encoding="utf-8")))
+        self.assertEqual(0, Asset.objects.all().count())
+        self.assertEqual(0, AssetChange.objects.all().count())
+        self.assertEqual(0, Text.objects.all().count())
+        self.assertEqual(2, AssetType.objects.filter(type_name__in=["span-regular", "block-paragraph"]).count())
@@ -1,136 +1,403 @@
 from django.shortcuts import render
-from django.db import connection
+from django.conf import settings
+from django.db import connection, models, transaction
 from django.db.utils import OperationalError
+from django.db.models import Count, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Substr
 from django.http import HttpResponseBadRequest, HttpResponse, JsonResponse
-from AssetStorm.assets.models import AssetType, EnumType, Text, UriElement, Enum, Asset
-import json
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from AssetStorm.assets.models import AssetType, EnumType, Text, UriElement, Enum, Asset, WriteGeneration
+from AssetStorm.assets.models import AssetAccessStatistic, AssetChange, CacheInvalidation, CacheRebuildJob
+from AssetStorm.assets.models import CONTENT_CACHE_FIELDS
+from AssetStorm.assets.caches import GenerationCache, asset_cache, asset_cache_key, stale_asset_cache_key
+from AssetStorm.assets.locks import single_flight, lock_id
+from AssetStorm.assets import codec
+from AssetStorm.assets.diff import structure_operations, add_leaf_values
 import yaml
 import uuid
+import time
 import os
 
 
+REBUILD_BATCH_SIZE = 500
+
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+
+QUERY_FIELD_COLUMNS = {
+    "id": "pk",
+    "type_id": "t_id",
+    "raw_content_snippet": "raw_content_snippet"
+}
+
+find_result_cache = GenerationCache(settings.FIND_RESULT_CACHE_SIZE)
+
+
 class AssetStructureError(Exception):
     def __init__(self, asset=None, *args):
         super(Exception, self).__init__(*args)
         self.asset = asset
 
 
+def get_fresh_cached_contents(asset_ids: list) -> dict:
+    """
+    Looks up the serialized contents of the assets in the shared asset cache. Entries which were built
+    from an outdated version of the asset or of one of its sub-assets are skipped. Checking them costs
+    one query.
+    """
+    cached_contents = asset_cache().get_many([asset_cache_key(asset_id) for asset_id in asset_ids])
+    current_versions = Asset.current_versions([versions for _, versions in cached_contents.values()])
+    fresh_contents = {}
+    for asset_id in asset_ids:
+        if asset_cache_key(asset_id) in cached_contents:
+            serialized_content, versions = cached_contents[asset_cache_key(asset_id)]
+            if Asset.versions_match(versions, current_versions):
+                fresh_contents[asset_id] = serialized_content
+    return fresh_contents
+
+
 def load_asset(request):
     if "id" not in request.GET:
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "Please supply a 'id' as a GET param."
         }), content_type="application/json")
+    if "depth" in request.GET:
+        try:
+            depth = int(request.GET["depth"])
+        except ValueError:
+            depth = -1
+        if depth < 0:
+            return HttpResponseBadRequest(content=codec.dumps({
+                "Error": "The depth must be a non-negative integer."
+            }), content_type="application/json")
+    if "at" in request.GET:
+        try:
+            at = parse_datetime(request.GET["at"])
+        except ValueError:
+            at = None
+        if at is None:
+            return HttpResponseBadRequest(content=codec.dumps({
+                "Error": "The time 'at' must be an ISO 8601 datetime like 2020-04-01T12:00:00+02:00."
+            }), content_type="application/json")
+        if timezone.is_naive(at):
+            at = timezone.make_aware(at)
     try:
-        asset = Asset.objects.get(pk=request.GET["id"])
-        return HttpResponse(content=json.dumps(asset.content),
+        asset_id = uuid.UUID(request.GET["id"])
+        if "at" in request.GET:
+            content = Asset.objects.select_related("t").get(pk=asset_id).content_at(
+                at, depth if "depth" in request.GET else None)
+            if content is None:
+                return HttpResponseBadRequest(content=codec.dumps({
+                    "Error": "The Asset with id=%s did not exist at %s." % (request.GET["id"], request.GET["at"])
+                }), content_type="application/json")
+            return HttpResponse(content=codec.dumps(content),
+                                content_type="application/json")
+        if "depth" in request.GET:
+            asset = Asset.objects.get(pk=asset_id)
+            AssetAccessStatistic.record([asset_id])
+            return HttpResponse(content=codec.dumps(asset.content_to_depth(depth)),
+                                content_type="application/json")
+        serialized_content = get_fresh_cached_contents([asset_id]).get(asset_id)
+        if serialized_content is None:
+            with single_flight(lock_id("content_cache", asset_id)) as flight:
+                if not flight.acquired:
+                    serialized_content = asset_cache().get(stale_asset_cache_key(asset_id))
+                if serialized_content is None:
+                    serialized_contents = Asset.load_serialized_contents([asset_id])
+                    if asset_id not in serialized_contents:
+                        raise Asset.DoesNotExist
+                    asset_cache().set(asset_cache_key(asset_id), serialized_contents[asset_id])
+                    serialized_content = serialized_contents[asset_id][0]
+        AssetAccessStatistic.record([asset_id])
+        return HttpResponse(content=serialized_content,
                             content_type="application/json")
-    except Asset.DoesNotExist:
-        return HttpResponseBadRequest(content=json.dumps({
+    except (ValueError, Asset.DoesNotExist):
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "No Asset with id=%s found." % request.GET["id"]
         }), content_type="application/json")
 
 
-def save_asset(request):
-    def check_type(expected_type, actual_type, asset_type_name, current_key, current_tree):
-        if expected_type == 1:
-            if actual_type is not str:
-                raise AssetStructureError(
-                    current_tree,
-                    "The Schema of AssetType '%s' demands the content for key '%s' to be a string." % (
-                        asset_type_name,
-                        current_key))
-        elif expected_type == 2:
-            if actual_type is not str:
-                raise AssetStructureError(
-                    current_tree,
-                    "The Schema of AssetType '%s' demands the content for key '%s' to be a string with a URI." % (
-                        asset_type_name,
-                        current_key))
-        elif type(expected_type) is dict and \
-                len(expected_type.keys()) == 1 and \
-                "3" in expected_type.keys():
+def load_many_assets(request):
+    if "id" not in request.GET:
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "Please supply at least one 'id' as a GET param."
+        }), content_type="application/json")
+    asset_ids = []
+    for asset_id in request.GET.getlist("id"):
+        try:
+            asset_ids.append(uuid.UUID(asset_id))
+        except ValueError:
+            return HttpResponseBadRequest(content=codec.dumps({
+                "Error": "The id '%s' is not a valid uuid (v4)." % asset_id
+            }), content_type="application/json")
+    serialized_contents = get_fresh_cached_contents(asset_ids)
+    missing_ids = [asset_id for asset_id in dict.fromkeys(asset_ids) if asset_id not in serialized_contents]
+    if len(missing_ids) > 0:
+        loaded_contents = Asset.load_serialized_contents(missing_ids)
+        for asset_id in missing_ids:
+            if asset_id not in loaded_contents:
+                return HttpResponseBadRequest(content=codec.dumps({
+                    "Error": "No Asset with id=%s found." % str(asset_id)
+                }), content_type="application/json")
+        asset_cache().set_many({
+            asset_cache_key(asset_id): loaded_content
+            for asset_id, loaded_content in loaded_contents.items()
+        })
+        for asset_id, (serialized_content, _) in loaded_contents.items():
+            serialized_contents[asset_id] = serialized_content
+    AssetAccessStatistic.record(asset_ids)
+    return HttpResponse(content=b"[" + b",".join(serialized_contents[asset_id] for asset_id in asset_ids) + b"]",
+                        content_type="application/json")
+
+
+def load_history(request):
+    if "id" not in request.GET:
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "Please supply a 'id' as a GET param."
+        }), content_type="application/json")
+    try:
+        asset_id = uuid.UUID(request.GET["id"])
+    except ValueError:
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "The id '%s' is not a valid uuid (v4)." % request.GET["id"]
+        }), content_type="application/json")
+    try:
+        offset = int(request.GET.get("offset", "0"))
+        limit = int(request.GET.get("limit", str(HISTORY_PAGE_SIZE)))
+    except ValueError:
+        offset = -1
+        limit = -1
+    if offset < 0 or limit < 1 or limit > MAX_HISTORY_PAGE_SIZE:
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "offset must be a non-negative integer and limit an integer between 1 and %d." %
+                     MAX_HISTORY_PAGE_SIZE
+        }), content_type="application/json")
+    revisions = Asset.revision_history(asset_id, offset, limit + 1)
+    if offset == 0 and len(revisions) < 1:
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "No Asset with id=%s found." % request.GET["id"]
+        }), content_type="application/json")
+    has_more = len(revisions) > limit
+    revisions = revisions[:limit]
+    if request.GET.get("content", "false") == "true":
+        add_revision_contents(revisions)
+    return HttpResponse(content=codec.dumps({
+        "id": str(asset_id),
+        "offset": offset,
+        "limit": limit,
+        "has_more": has_more,
+        "revisions": revisions
+    }), content_type="application/json")
+
+
+def add_revision_contents(revisions: list):
+    """
+    Adds the content to every revision. The current revision is loaded like /load does. Previous revisions
+    are copies which keep the content cache of the time they were replaced, so their snapshot is used
+    instead of rendering them again from the current sub-assets.
+    """
+    snapshots = {
+        str(pk): (serialized_content, content)
+        for pk, serialized_content, content in Asset.objects.filter(pk__in=[
+            revision["id"] for revision in revisions if revision["revision"] > 0]).values_list(
+            "pk", "serialized_content_cache", "content_cache")
+    }
+    for revision in revisions:
+        if revision["revision"] == 0:
+            serialized_content = Asset.load_serialized_contents([revision["id"]])[uuid.UUID(revision["id"])][0]
+            revision["content"] = codec.loads(serialized_content)
+        else:
+            serialized_content, content = snapshots[revision["id"]]
+            revision["content"] = content if serialized_content is None else codec.loads(bytes(serialized_content))
+
+
+def diff_revisions(request):
+    """
+    Compares two revisions. Without an id, from and to are the ids of two assets whose current structures
+    get compared, like a previous revision from /history and the current one. With an id, from and to are
+    ISO datetimes and the structures of that asset at these times get compared. Sub-assets are compared by
+    their ids only.
+    """
+    if "from" not in request.GET or "to" not in request.GET:
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "Please supply 'from' and 'to' as GET params."
+        }), content_type="application/json")
+    try:
+        if "id" in request.GET:
+            asset = Asset.objects.select_related("t").get(pk=uuid.UUID(request.GET["id"]))
+            try:
+                times = [parse_datetime(request.GET["from"]), parse_datetime(request.GET["to"])]
+            except ValueError:
+                times = [None]
+            if None in times:
+                return HttpResponseBadRequest(content=codec.dumps({
+                    "Error": "With an 'id' the params 'from' and 'to' must be ISO 8601 datetimes."
+                }), content_type="application/json")
+            times = [timezone.make_aware(at) if timezone.is_naive(at) else at for at in times]
+            from_asset, to_asset = asset, asset
+            from_structure, to_structure = asset.structure_at(times[0]), asset.structure_at(times[1])
+        else:
+            revision_ids = [uuid.UUID(request.GET["from"]), uuid.UUID(request.GET["to"])]
+            revisions = Asset.objects.select_related("t").in_bulk(revision_ids)
+            if revision_ids[0] not in revisions or revision_ids[1] not in revisions:
+                raise Asset.DoesNotExist
+            from_asset, to_asset = revisions[revision_ids[0]], revisions[revision_ids[1]]
+            structures = Asset.head_structures(revision_ids)
+            from_structure, to_structure = structures.get(revision_ids[0]), structures.get(revision_ids[1])
+    except (ValueError, Asset.DoesNotExist):
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "No Asset found for the supplied ids."
+        }), content_type="application/json")
+    if from_structure is None or to_structure is None:
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "At least one of the revisions has no structure to compare."
+        }), content_type="application/json")
+    schema = dict(from_asset.t.schema)
+    schema.update(to_asset.t.schema)
+    operations = add_leaf_values(schema, structure_operations(schema, from_structure, to_structure))
+    return HttpResponse(content=codec.dumps({
+        "from": request.GET["from"],
+        "to": request.GET["to"],
+        "from_type": from_asset.t.type_name,
+        "to_type": to_asset.t.type_name,
+        "operations": operations
+    }), content_type="application/json")
+
+
+class SchemaTypes:
+    """
+    All AssetTypes and EnumTypes in memory, so check_asset can validate many trees without a query per node.
+    """
+    def __init__(self):
+        self.asset_types = {asset_type.type_name: asset_type
+                            for asset_type in AssetType.objects.select_related("parent_type")}
+        self.enum_types = EnumType.objects.in_bulk()
+
+    def asset_type(self, type_name):
+        if type_name not in self.asset_types:
+            raise AssetType.DoesNotExist
+        return self.asset_types[type_name]
+
+    def enum_type(self, pk):
+        if pk not in self.enum_types:
+            raise EnumType.DoesNotExist
+        return self.enum_types[pk]
+
+
+def check_type(expected_type, actual_type, asset_type_name, current_key, current_tree, schema_types=None):
+    if expected_type == 1:
+        if actual_type is not str:
+            raise AssetStructureError(
+                current_tree,
+                "The Schema of AssetType '%s' demands the content for key '%s' to be a string." % (
+                    asset_type_name,
+                    current_key))
+    elif expected_type == 2:
+        if actual_type is not str:
+            raise AssetStructureError(
+                current_tree,
+                "The Schema of AssetType '%s' demands the content for key '%s' to be a string with a URI." % (
+                    asset_type_name,
+                    current_key))
+    elif type(expected_type) is dict and \
+            len(expected_type.keys()) == 1 and \
+            "3" in expected_type.keys():
+        if schema_types is None:
             enum_type = EnumType.objects.get(pk=expected_type["3"])
-            if current_tree[current_key] not in enum_type.items:
-                raise AssetStructureError(
-                    current_tree,
-                    "The Schema of AssetType '%s' demands the content for key '%s' to be the enum_type with id=%d." % (
-                        asset_type_name,
-                        current_key,
-                        enum_type.pk))
         else:
-            if actual_type is dict:
-                check_asset(current_tree, expected_asset_type_id=expected_type)
-            else:
-                raise AssetStructureError(
-                    current_tree,
-                    "The Schema of AssetType '%s' demands the content for key '%s' to be an Asset." % (
-                        asset_type_name,
-                        current_key) +
-                    " Assets are saved as JSON-objects with an inner structure matching the schema " +
-                    "of their type.")
-
-    def check_asset(tree, expected_asset_type_id=None):
-        try:
-            if "id" in tree.keys():
-                try:
-                    uuid.UUID(tree["id"], version=4)
-                except ValueError:
-                    raise AssetStructureError(tree, "The id '%s' is not a valid uuid (v4)." % tree["id"])
-                Asset.objects.get(pk=tree["id"])
-                if "type" not in tree.keys():
-                    return None
+            enum_type = schema_types.enum_type(expected_type["3"])
+        if current_tree[current_key] not in enum_type.items:
+            raise AssetStructureError(
+                current_tree,
+                "The Schema of AssetType '%s' demands the content for key '%s' to be the enum_type with id=%d." % (
+                    asset_type_name,
+                    current_key,
+                    enum_type.pk))
+    else:
+        if actual_type is dict:
+            check_asset(current_tree, expected_asset_type_id=expected_type, schema_types=schema_types)
+        else:
+            raise AssetStructureError(
+                current_tree,
+                "The Schema of AssetType '%s' demands the content for key '%s' to be an Asset." % (
+                    asset_type_name,
+                    current_key) +
+                " Assets are saved as JSON-objects with an inner structure matching the schema " +
+                "of their type.")
+
+
+def check_asset(tree, expected_asset_type_id=None, schema_types=None):
+    try:
+        if "id" in tree.keys():
+            try:
+                uuid.UUID(tree["id"], version=4)
+            except ValueError:
+                raise AssetStructureError(tree, "The id '%s' is not a valid uuid (v4)." % tree["id"])
+            Asset.objects.get(pk=tree["id"])
+            if "type" not in tree.keys():
+                return None
+        if schema_types is None:
             asset_type = AssetType.objects.get(type_name=tree["type"])
-            if expected_asset_type_id is not None and (
-                    asset_type.pk != expected_asset_type_id and
-                    asset_type.parent_type.pk != expected_asset_type_id):
+        else:
+            asset_type = schema_types.asset_type(tree["type"])
+        if expected_asset_type_id is not None and (
+                asset_type.pk != expected_asset_type_id and
+                asset_type.parent_type.pk != expected_asset_type_id):
+            raise AssetStructureError(
+                tree,
+                "Expected an AssetType with id %d but got '%s' with id %d." % (
+                    expected_asset_type_id,
+                    asset_type.type_name,
+                    asset_type.pk))
+        for key in asset_type.schema.keys():
+            if key not in tree:
                 raise AssetStructureError(
                     tree,
-                    "Expected an AssetType with id %d but got '%s' with id %d." % (
-                        expected_asset_type_id,
-                        asset_type.type_name,
-                        asset_type.pk))
-            for key in asset_type.schema.keys():
-                if key not in tree:
+                    "Missing key '%s' in AssetType '%s'." % (
+                        key,
+                        asset_type.type_name))
+            if type(asset_type.schema[key]) is list:
+                if type(tree[key]) is not list:
                     raise AssetStructureError(
                         tree,
-                        "Missing key '%s' in AssetType '%s'." % (
-                            key,
-                            asset_type.type_name))
-                if type(asset_type.schema[key]) is list:
-                    if type(tree[key]) is not list:
-                        raise AssetStructureError(
-                            tree,
-                            "The Schema of AssetType '%s' demands the content for key '%s' to be a List." % (
-                                asset_type.type_name,
-                                key))
-                    for list_item in tree[key]:
-                        check_type(asset_type.schema[key][0],
-                                   type(list_item),
-                                   asset_type.type_name,
-                                   key,
-                                   list_item)
-                elif type(asset_type.schema[key]) is int and \
-                        asset_type.schema[key] >= 4:
-                    check_type(asset_type.schema[key],
-                               type(tree[key]),
-                               asset_type.type_name,
-                               key,
-                               tree[key])
-                else:
-                    check_type(asset_type.schema[key],
-                               type(tree[key]),
+                        "The Schema of AssetType '%s' demands the content for key '%s' to be a List." % (
+                            asset_type.type_name,
+                            key))
+                for list_item in tree[key]:
+                    check_type(asset_type.schema[key][0],
+                               type(list_item),
                                asset_type.type_name,
                                key,
-                               tree)
-        except KeyError as err:
-            raise AssetStructureError(tree, "Missing key in Asset: " + str(err))
-        except AssetType.DoesNotExist:
-            raise AssetStructureError(tree, "Unknown AssetType: " + tree["type"])
-        except EnumType.DoesNotExist:
-            raise AssetStructureError(tree, "Unknown EnumType: %s." % str(tree[key]))
-        except Asset.DoesNotExist:
-            raise AssetStructureError(tree, "An Asset with id %s does not exist." % tree["id"])
+                               list_item,
+                               schema_types)
+            elif type(asset_type.schema[key]) is int and \
+                    asset_type.schema[key] >= 4:
+                check_type(asset_type.schema[key],
+                           type(tree[key]),
+                           asset_type.type_name,
+                           key,
+                           tree[key],
+                           schema_types)
+            else:
+                check_type(asset_type.schema[key],
+                           type(tree[key]),
+                           asset_type.type_name,
+                           key,
+                           tree,
+                           schema_types)
+    except KeyError as err:
+        raise AssetStructureError(tree, "Missing key in Asset: " + str(err))
+    except AssetType.DoesNotExist:
+        raise AssetStructureError(tree, "Unknown AssetType: " + tree["type"])
+    except EnumType.DoesNotExist:
+        raise AssetStructureError(tree, "Unknown EnumType: %s." % str(tree[key]))
+    except Asset.DoesNotExist:
+        raise AssetStructureError(tree, "An Asset with id %s does not exist." % tree["id"])
+
 
+def save_asset(request):
     def create_asset(tree, item_type=None):
         if item_type == 1:
             text_item = Text(text=tree)
@@ -156,8 +423,7 @@ def save_asset(request):
                 content_ids[key] = item_ids_list
             else:
                 content_ids[key] = create_or_modify_asset(tree[key], item_type=asset_type.schema[key])
-        asset = Asset(t=asset_type, content_ids=content_ids)
-        asset.save()
+        asset = Asset.produce(t=asset_type, content_ids=content_ids)
         return str(asset.pk)
 
     def modify_asset(tree):
@@ -165,47 +431,55 @@ def save_asset(request):
         old_asset.pk = None
         old_asset.save()
         asset = Asset.objects.get(pk=tree["id"])
+        asset.keep_stale_content()
         asset.revision_chain = old_asset
         asset.content_cache = None
+        asset.serialized_content_cache = None
         asset.clear_reference_lists()
-        asset.save()
-        changed = False
+        asset.save(update_fields=["revision_chain"] + CONTENT_CACHE_FIELDS)
+        head_change = asset.change_chain
+        if head_change is None:
+            structure = AssetChange.empty_structure(asset.t.schema)
+        else:
+            structure = head_change.structure
+        changed_keys = {}
         for key in asset.t.schema.keys():
             if key in tree:
                 if asset.t.schema[key] == 1:
-                    old_text = Text.objects.get(pk=asset.content_ids[key])
-                    if tree[key] != old_text.text:
-                        changed = True
-                        asset.content_ids[key] = create_asset(tree[key], item_type=asset.t.schema[key])
+                    old_text = Text.objects.filter(pk=structure[key]).first()
+                    if old_text is None or tree[key] != old_text.text:
+                        changed_keys[key] = create_asset(tree[key], item_type=asset.t.schema[key])
                 elif asset.t.schema[key] == 2:
-                    old_uri = UriElement.objects.get(pk=asset.content_ids[key])
-                    if tree[key] != old_uri.uri:
-                        changed = True
-                        asset.content_ids[key] = create_asset(tree[key], item_type=asset.t.schema[key])
+                    old_uri = UriElement.objects.filter(pk=structure[key]).first()
+                    if old_uri is None or tree[key] != old_uri.uri:
+                        changed_keys[key] = create_asset(tree[key], item_type=asset.t.schema[key])
                 elif type(asset.t.schema[key]) is dict and \
                         len(asset.t.schema[key].keys()) == 1 and \
                         "3" in asset.t.schema[key].keys():
-                    old_enum = Enum.objects.get(pk=asset.content_ids[key])
-                    if tree[key] != old_enum.item:
-                        changed = True
-                        asset.content_ids[key] = create_asset(tree[key], item_type=asset.t.schema[key])
+                    old_enum = Enum.objects.filter(pk=structure[key]).first()
+                    if old_enum is None or tree[key] != old_enum.item:
+                        changed_keys[key] = create_asset(tree[key], item_type=asset.t.schema[key])
                 elif type(asset.t.schema[key]) is list:
                     item_ids_list = []
                     for list_item in tree[key]:
                         item_ids_list.append(create_or_modify_asset(list_item, item_type=asset.t.schema[key][0]))
-                    for i, new_item in enumerate(item_ids_list):
-                        if old_asset.content_ids[key][i] != new_item:
-                            changed = True
-                    asset.content_ids[key] = item_ids_list
+                    if item_ids_list != structure[key]:
+                        changed_keys[key] = item_ids_list
+                else:
+                    sub_asset_id = create_or_modify_asset(tree[key], item_type=asset.t.schema[key])
+                    if sub_asset_id != structure[key]:
+                        changed_keys[key] = sub_asset_id
+        if len(changed_keys) > 0:
+            old_asset.record_revision_snapshot(structure, head_change)
+            for key, inserts in changed_keys.items():
+                if type(asset.t.schema[key]) is list:
+                    asset.change(key, delete_count=len(structure[key]), inserts=inserts)
                 else:
-                    asset.content_ids[key] = create_or_modify_asset(tree[key], item_type=asset.t.schema[key])
-                    if asset.content_ids[key] != old_asset.content_ids[key]:
-                        changed = True
-        if changed:
-            asset.clear_cache()
+                    asset.change(key, inserts=inserts)
+            asset.invalidate()
         else:
             asset.revision_chain = old_asset.revision_chain
-            asset.save()
+            asset.save(update_fields=["revision_chain"])
             old_asset.delete()
         return str(asset.pk)
 
@@ -215,19 +489,21 @@ def save_asset(request):
         return create_asset(tree, item_type)
 
     try:
-        full_tree = json.loads(request.body, encoding='utf-8')
+        full_tree = codec.loads(request.body)
         check_asset(full_tree)
-        asset_pk = create_or_modify_asset(full_tree)
-        return HttpResponse(content=json.dumps({
+        with transaction.atomic():
+            asset_pk = create_or_modify_asset(full_tree)
+        WriteGeneration.bump()
+        return HttpResponse(content=codec.dumps({
             "success": True,
             "id": asset_pk
         }), content_type="application/json")
-    except json.decoder.JSONDecodeError:
-        return HttpResponseBadRequest(content=json.dumps({
+    except codec.JSONDecodeError:
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "Request not in JSON format. The requests body has to be valid JSON."
         }), content_type="application/json")
     except AssetStructureError as asset_error:
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": str(asset_error),
             "Asset": asset_error.asset
         }), content_type="application/json")
@@ -242,45 +518,78 @@ def turnout(request):
 
 def query(request, query_string=""):
     if request.content_type != "application/json" and len(request.body) > 0:
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "If you supply filters they need to be valid JSON and " +
                      "the request must have the MIME-type \"application/json\"."
         }), content_type="application/json")
+    fields = [field for field in request.GET.get("fields", "").split(",") if len(field) > 0]
+    for field in fields:
+        if field not in QUERY_FIELD_COLUMNS.keys():
+            return HttpResponseBadRequest(content=codec.dumps({
+                "Error": "Unknown field \"%s\". Possible fields are: %s." % (
+                    field, ", ".join(QUERY_FIELD_COLUMNS.keys()))
+            }), content_type="application/json")
+    if len(fields) < 1:
+        fields = list(QUERY_FIELD_COLUMNS.keys())
     try:
         if request.body is not None and len(request.body) > 0 and request.content_type == "application/json":
-            json_filters = json.loads(request.body, encoding='utf-8')
+            json_filters = codec.loads(request.body)
         else:
             json_filters = {}
+        with_type_counts = request.GET.get("type_counts", "false").lower() in ["1", "true"]
+        cache_key = (query_string, codec.dumps(json_filters, sort_keys=True), tuple(fields), with_type_counts)
+        generation = WriteGeneration.current()
+        cached_response = find_result_cache.get(generation, cache_key)
+        if cached_response is not None:
+            cached_content, found_ids = cached_response
+            AssetAccessStatistic.record(found_ids)
+            return HttpResponse(content=cached_content, content_type="application/json")
         found_assets = Asset.objects.filter(
             new_version=None).filter(
             raw_content_cache__icontains=query_string).filter(
-            content_cache__contains=json_filters)
-        return HttpResponse(content=json.dumps({
-            "assets": [{
-                "id": str(a.pk),
-                "type_id": a.t.pk,
-                "raw_content_snippet": a.raw_content_cache[:500]
-            } for a in found_assets]
-        }), content_type="application/json")
-    except json.decoder.JSONDecodeError:
-        return HttpResponseBadRequest(content=json.dumps({
+            content_cache__contains=json_filters).filter(
+            RawSQL(Asset.fresh_cache_sql("raw_cache_versions"), [], output_field=models.BooleanField())).filter(
+            RawSQL(Asset.fresh_cache_sql("content_cache_versions"), [], output_field=models.BooleanField()))
+        query_response = {}
+        if with_type_counts:
+            query_response["type_counts"] = {
+                type_count["t__type_name"]: type_count["count"]
+                for type_count in found_assets.order_by().values("t__type_name").annotate(count=Count("pk"))
+            }
+        if "raw_content_snippet" in fields:
+            found_assets = found_assets.annotate(raw_content_snippet=Substr("raw_content_cache", 1, 500))
+        query_response["assets"] = []
+        for row in found_assets.values_list(*[QUERY_FIELD_COLUMNS[field] for field in fields]):
+            asset_info = dict(zip(fields, row))
+            if "id" in asset_info:
+                asset_info["id"] = str(asset_info["id"])
+            query_response["assets"].append(asset_info)
+        found_ids = []
+        if "id" in fields:
+            found_ids = [asset_info["id"] for asset_info in query_response["assets"]]
+            AssetAccessStatistic.record(found_ids)
+        response_content = codec.dumps(query_response)
+        find_result_cache.put(generation, cache_key, (response_content, found_ids))
+        return HttpResponse(content=response_content, content_type="application/json")
+    except codec.JSONDecodeError:
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "The filters are not in JSON format. The request body has to be valid JSON."
         }), content_type="application/json")
 
 
 def get_template(request):
     if "type_name" not in request.GET or "template_type" not in request.GET:
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "You must supply template_type and type_name as GET params."
         }), content_type="application/json")
     try:
         ato = AssetType.objects.get(type_name=request.GET["type_name"])
     except AssetType.DoesNotExist:
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "The AssetType \"" + request.GET["type_name"] + "\" does not exist."
         }), content_type="application/json")
     if request.GET["template_type"] not in ato.templates.keys():
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "The AssetType \"" + request.GET["type_name"] +
                      "\" has no template \"" + request.GET["template_type"] + "\"."
         }), content_type="application/json")
@@ -314,52 +623,243 @@ def get_schema(request):
 
 def get_types_for_parent(request):
     if "parent_type_name" not in request.GET and "parent_type_id" not in request.GET:
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "You must supply parent_type_name or parent_type_id as GET param."
         }), content_type="application/json")
     if "parent_type_id" in request.GET:
         try:
             parent = AssetType.objects.get(pk=int(request.GET["parent_type_id"]))
         except AssetType.DoesNotExist:
-            return HttpResponseBadRequest(content=json.dumps({
+            return HttpResponseBadRequest(content=codec.dumps({
                 "Error": "The AssetType with id=" + request.GET["parent_type_id"] + " does not exist."
             }), content_type="application/json")
     else:
         try:
             parent = AssetType.objects.get(type_name=request.GET["parent_type_name"])
         except AssetType.DoesNotExist:
-            return HttpResponseBadRequest(content=json.dumps({
+            return HttpResponseBadRequest(content=codec.dumps({
                 "Error": "The AssetType \"" + request.GET["parent_type_name"] + "\" does not exist."
             }), content_type="application/json")
     children = [child.type_name for child in parent.children.all()]
     if len(children) < 1:
         children = [parent.type_name]
-    return HttpResponse(content=json.dumps(children),
+    return HttpResponse(content=codec.dumps(children),
                         content_type="application/json")
 
 
-def update_caches(request=None) -> HttpResponse:
+def missing_or_outdated_caches(cache_field: str, versions_field: str, asset_ids: list = None) -> Q:
+    """
+    Matches the assets whose cache is missing or outdated. If asset_ids is given only these assets are
+    checked, so the recorded versions of the rest of the table are not scanned.
+    """
+    if asset_ids is None:
+        return Q(**{cache_field + "__isnull": True}) | \
+            Q(pk__in=RawSQL(Asset.outdated_cache_ids_sql(versions_field), []))
+    return Q(pk__in=asset_ids) & (Q(**{cache_field + "__isnull": True}) | Q(pk__in=RawSQL(
+        Asset.outdated_cache_ids_sql(versions_field, restricted=True), [[str(pk) for pk in asset_ids]])))
+
+
+def missing_or_outdated_content_caches(asset_ids: list = None) -> Q:
+    return missing_or_outdated_caches("content_cache", "content_cache_versions", asset_ids)
+
+
+def missing_or_outdated_raw_caches(asset_ids: list = None) -> Q:
+    return missing_or_outdated_caches("raw_content_cache", "raw_cache_versions", asset_ids)
+
+
+def rebuild_caches(asset_filter: Q = Q(), progress=None, asset_ids: list = None) -> dict:
+    """
+    Builds all missing or outdated content caches and raw templates of the assets matching asset_filter.
+    If asset_ids is given only these assets are considered and only their caches are checked for staleness.
+    The assets are processed in dependency order (sub-assets first), so every asset is built exactly once
+    and only from warm caches of its sub-assets. The dependency graph is built from streamed head structures
+    and every level is built in batches of REBUILD_BATCH_SIZE, so the memory use is bounded by the ids and
+    sub-asset ids of the cold assets plus one batch of instances.
+    progress gets called with the statistics and the total numbers of caches to build after every batch.
+    """
+    statistics = {
+        'rebuilt_content_caches': 0,
+        'rendered_raw_templates': 0
+    }
+    totals = {
+        'rebuilt_content_caches': None,
+        'rendered_raw_templates': None
+    }
+    content_ids = list(Asset.objects.filter(asset_filter).filter(
+        missing_or_outdated_content_caches(asset_ids)).values_list("pk", flat=True))
+    totals['rebuilt_content_caches'] = len(content_ids)
+    for level in Asset.dependency_levels(content_ids):
+        for start in range(0, len(level), REBUILD_BATCH_SIZE):
+            batch = level[start:start + REBUILD_BATCH_SIZE]
+            Asset.load_contents(list(Asset.objects.select_related("t").defer(
+                "raw_content_cache", "serialized_content_cache").filter(pk__in=batch)))
+            statistics['rebuilt_content_caches'] += len(batch)
+            if progress is not None:
+                progress(statistics, totals)
+    raw_ids = list(Asset.objects.filter(asset_filter).filter(
+        missing_or_outdated_raw_caches(asset_ids)).values_list("pk", flat=True))
+    totals['rendered_raw_templates'] = len(raw_ids)
+    for level in Asset.dependency_levels(raw_ids):
+        for start in range(0, len(level), REBUILD_BATCH_SIZE):
+            for asset in Asset.objects.select_related("t").defer(
+                    "content_cache", "serialized_content_cache").filter(
+                    pk__in=level[start:start + REBUILD_BATCH_SIZE]):
+                asset.render_template()
+                statistics['rendered_raw_templates'] += 1
+            if progress is not None:
+                progress(statistics, totals)
+    WriteGeneration.bump()
+    return statistics
+
+
+def prerender_templates(template_keys: list = None, asset_filter: Q = Q()) -> dict:
+    """
+    Renders the given template keys (all keys of every type if template_keys is None) of the assets
+    matching asset_filter into the persistent template caches. Assets are processed in dependency order
+    and every batch shares its loaded leaves, sub-assets and renders across all formats.
+    """
+    statistics = {
+        'prerendered_templates': 0
+    }
+    asset_ids = list(Asset.objects.filter(asset_filter).values_list("pk", flat=True))
+    for level in Asset.dependency_levels(asset_ids):
+        for start in range(0, len(level), REBUILD_BATCH_SIZE):
+            shared = {}
+            for asset in Asset.objects.select_related("t").defer(
+                    "content_cache", "serialized_content_cache").filter(
+                    pk__in=level[start:start + REBUILD_BATCH_SIZE]).iterator(chunk_size=REBUILD_BATCH_SIZE):
+                shared[(Asset, asset.pk)] = asset
+                for template_key in asset.t.templates.keys():
+                    if template_keys is None or template_key in template_keys:
+                        asset.render_template(template_key, shared=shared)
+                        statistics['prerendered_templates'] += 1
+    return statistics
+
+
+def process_cache_invalidations(batch_size: int) -> dict:
+    """
+    Claims one batch from the invalidation queue, drops the shared cache entries of the changed assets and
+    of all assets built from them and rebuilds their caches. Returns zero counts if the queue is empty.
+    Only the claim runs in a transaction. The rebuild commits batch by batch outside of it, so no row lock
+    of the rebuild is held while /save and /load wait for it. If the rebuild fails the claimed entries are
+    gone, but readers still recognize the outdated caches by their versions.
+    """
     statistics = {
+        'processed_invalidations': 0,
         'rebuilt_content_caches': 0,
         'rendered_raw_templates': 0
     }
-    for asset in Asset.objects.filter(content_cache__isnull=True):
-        asset.content
-        statistics['rebuilt_content_caches'] += 1
-    for asset in Asset.objects.filter(raw_content_cache__isnull=True):
-        asset.render_template()
-        statistics['rendered_raw_templates'] += 1
-    statistics['Success'] = True
-    return HttpResponse(content=json.dumps(statistics),
+    with transaction.atomic():
+        changed_ids = CacheInvalidation.claim(batch_size)
+    if len(changed_ids) < 1:
+        return statistics
+    changed_keys = [str(asset_id) for asset_id in changed_ids]
+    affected_ids = changed_ids + list(Asset.objects.filter(
+        Q(content_cache_versions__has_any_keys=changed_keys) |
+        Q(raw_cache_versions__has_any_keys=changed_keys)).values_list("pk", flat=True))
+    asset_cache().delete_many([asset_cache_key(asset_id) for asset_id in affected_ids])
+    statistics.update(rebuild_caches(asset_ids=affected_ids))
+    statistics['processed_invalidations'] = len(changed_ids)
+    return statistics
+
+
+def run_cache_rebuild_job(job: CacheRebuildJob) -> CacheRebuildJob:
+    """
+    Runs the rebuild of a claimed job. Progress and a heartbeat are recorded after every batch and the final
+    totals and statistics when the job finishes.
+    """
+    totals = {
+        'rebuilt_content_caches': None,
+        'rendered_raw_templates': None
+    }
+
+    def save_progress(statistics, progress_totals):
+        totals.update(progress_totals)
+        CacheRebuildJob.objects.filter(pk=job.pk).update(
+            content_caches_total=totals['rebuilt_content_caches'],
+            rebuilt_content_caches=statistics['rebuilt_content_caches'],
+            raw_templates_total=totals['rendered_raw_templates'],
+            rendered_raw_templates=statistics['rendered_raw_templates'],
+            heartbeat=timezone.now())
+
+    try:
+        statistics = rebuild_caches(progress=save_progress)
+        job.status = CacheRebuildJob.DONE
+        job.rebuilt_content_caches = statistics['rebuilt_content_caches']
+        job.rendered_raw_templates = statistics['rendered_raw_templates']
+        job.content_caches_total = statistics['rebuilt_content_caches'] \
+            if totals['rebuilt_content_caches'] is None else totals['rebuilt_content_caches']
+        job.raw_templates_total = statistics['rendered_raw_templates'] \
+            if totals['rendered_raw_templates'] is None else totals['rendered_raw_templates']
+        job.finished = timezone.now()
+        job.save(update_fields=["status", "rebuilt_content_caches", "rendered_raw_templates",
+                                "content_caches_total", "raw_templates_total", "finished"])
+    except Exception as error:
+        job.status = CacheRebuildJob.FAILED
+        job.error = str(error)
+        job.finished = timezone.now()
+        job.save(update_fields=["status", "error", "finished"])
+    job.refresh_from_db()
+    return job
+
+
+def update_caches(request=None) -> HttpResponse:
+    job = CacheRebuildJob.enqueue()
+    return HttpResponse(content=codec.dumps({
+        "Success": True,
+        "job_id": str(job.pk),
+        "status": job.status
+    }), content_type="application/json", status=202)
+
+
+def job_status(request, job_id) -> HttpResponse:
+    try:
+        job = CacheRebuildJob.objects.get(pk=uuid.UUID(job_id))
+    except (ValueError, CacheRebuildJob.DoesNotExist):
+        return HttpResponseBadRequest(content=codec.dumps({
+            "Error": "No job with id=%s found." % job_id
+        }), content_type="application/json")
+    return HttpResponse(content=codec.dumps(job.as_dict()),
                         content_type="application/json")
 
 
+def warm_up_caches(time_budget: float = None, count_budget: int = None) -> dict:
+    """
+    Rebuilds the caches of the most accessed assets first and stores their content in the shared asset
+    cache. Stops after time_budget seconds or count_budget assets.
+    """
+    statistics = {
+        'warmed_up_assets': 0,
+        'rebuilt_content_caches': 0,
+        'rendered_raw_templates': 0
+    }
+    started = time.monotonic()
+    for asset in Asset.objects.select_related("t").filter(
+            access_statistic__isnull=False).order_by("-access_statistic__access_count").iterator():
+        if count_budget is not None and statistics['warmed_up_assets'] >= count_budget:
+            break
+        if time_budget is not None and time.monotonic() - started >= time_budget:
+            break
+        if not asset.content_cache_is_fresh():
+            asset.content
+            statistics['rebuilt_content_caches'] += 1
+        if "raw" in asset.t.templates.keys() and not asset.raw_content_cache_is_fresh():
+            asset.render_template()
+            statistics['rendered_raw_templates'] += 1
+        if asset.serialized_content_cache is not None:
+            asset_cache().set(asset_cache_key(asset.pk), (
+                bytes(asset.serialized_content_cache),
+                Asset.shared_cache_versions(asset.pk, asset.version, asset.content_cache_versions)))
+        statistics['warmed_up_assets'] += 1
+    return statistics
+
+
 def deliver_open_api_definition(request) -> HttpResponse:
     with open("AssetStormAPI.yaml", 'r') as yaml_file:
         api_definition = yaml.safe_load(yaml_file.read())
     if os.getenv("SERVER_NAME") is not None:
         api_definition["servers"][0]['url'] = os.getenv("SERVER_NAME")
-    return HttpResponse(content=json.dumps(api_definition),
+    return HttpResponse(content=codec.dumps(api_definition),
                         content_type="application/json")
 
 
@@ -371,11 +871,45 @@ def live(request):
         return HttpResponse(content="", content_type="text/plain", status=400)
 
 
+def truncate_all_assets() -> dict:
+    """
+    Empties the asset tables with one TRUNCATE ... CASCADE instead of loading every object into the
+    deletion collector. The tables are locked before they are counted, so the statistics match what
+    the TRUNCATE removes. They have the same shape as the ones of QuerySet.delete().
+    """
+    cascaded_models = [relation.related_model for relation in Asset._meta.related_objects
+                       if relation.on_delete is models.CASCADE and relation.related_model is not Asset]
+    tables = [model._meta.db_table for model in [Asset, Text, UriElement, Enum] + cascaded_models]
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("LOCK TABLE %s IN ACCESS EXCLUSIVE MODE" % ", ".join(tables))
+            counts = {}
+            for model in [Asset, Text, UriElement, Enum] + cascaded_models:
+                cursor.execute("SELECT COUNT(*) FROM %s" % model._meta.db_table)
+                counts[model] = cursor.fetchone()[0]
+            cursor.execute("TRUNCATE %s CASCADE" % ", ".join(tables))
+    delete_statistics = {}
+    for model in [Asset, Text, UriElement, Enum]:
+        detailed_delete_info = {model._meta.label: counts[model]}
+        if model is Asset:
+            detailed_delete_info.update({cascaded_model._meta.label: counts[cascaded_model]
+                                         for cascaded_model in cascaded_models if counts[cascaded_model] > 0})
+        delete_statistics[model.__name__] = sum(detailed_delete_info.values())
+        delete_statistics[model.__name__ + "_in_detail"] = detailed_delete_info
+    return delete_statistics
+
+
 def delete_all_assets(request):
     if request.method != "DELETE":
-        return HttpResponseBadRequest(content=json.dumps({
+        return HttpResponseBadRequest(content=codec.dumps({
             "Error": "Delete all assets by using a HTTP DELETE command. Other methods are disallowed."
         }), content_type="application/json")
+    if request.GET.get("fast", "false") == "true":
+        delete_statistics = truncate_all_assets()
+        asset_cache().clear()
+        WriteGeneration.bump()
+        return HttpResponse(content=codec.dumps(delete_statistics),
+                            content_type="application/json")
     delete_statistics = {}
     delete_count, detailed_delete_info = Asset.objects.all().delete()
     delete_statistics["Asset"] = delete_count
@@ -389,5 +923,7 @@ def delete_all_assets(request):
     delete_count, detailed_delete_info = Enum.objects.all().delete()
     delete_statistics["Enum"] = delete_count
     delete_statistics["Enum_in_detail"] = detailed_delete_info
-    return HttpResponse(content=json.dumps(delete_statistics),
+    asset_cache().clear()
+    WriteGeneration.bump()
+    return HttpResponse(content=codec.dumps(delete_statistics),
                         content_type="application/json")
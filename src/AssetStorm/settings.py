@@ -82,6 +82,42 @@ DATABASES = {
 
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
+# Caches
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# The "assets" cache holds the serialized content of hot assets. It must be shared by all gunicorn workers
+# so the default is a file based cache. Point AS_ASSET_CACHE_BACKEND to any other django cache backend
+# (e.g. locmem for a single process or memcached) to replace it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'assets': {
+        'BACKEND': os.environ.setdefault('AS_ASSET_CACHE_BACKEND',
+                                         'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.setdefault('AS_ASSET_CACHE_LOCATION', '/tmp/assetstorm_asset_cache'),
+        'TIMEOUT': int(os.environ.setdefault('AS_ASSET_CACHE_TIMEOUT', '600')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.setdefault('AS_ASSET_CACHE_MAX_ENTRIES', '10000')),
+        }
+    }
+}
+
+# Seconds a request waits for another worker which rebuilds the same cache before it gives up
+STAMPEDE_WAIT = float(os.environ.setdefault('AS_STAMPEDE_WAIT', '2'))
+
+# Share of /load and /find requests which update the access statistics used to prewarm caches
+ACCESS_SAMPLE_RATE = float(os.environ.setdefault('AS_ACCESS_SAMPLE_RATE', '0.05'))
+
+# Number of /find responses every worker keeps in memory until the next write
+FIND_RESULT_CACHE_SIZE = int(os.environ.setdefault('AS_FIND_RESULT_CACHE_SIZE', '256'))
+
+# Number of cache rebuild jobs one run_jobs worker executes at the same time
+JOB_CONCURRENCY = int(os.environ.setdefault('AS_JOB_CONCURRENCY', '1'))
+
+# Seconds without progress after which a running cache rebuild job counts as crashed and gets claimed again
+JOB_STALE_AFTER = float(os.environ.setdefault('AS_JOB_STALE_AFTER', '900'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
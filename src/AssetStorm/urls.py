@@ -14,14 +14,18 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import path
-from AssetStorm.assets.views import load_asset, save_asset, turnout, query
+from AssetStorm.assets.views import load_asset, load_many_assets, save_asset, turnout, query
+from AssetStorm.assets.views import load_history, diff_revisions
 from AssetStorm.assets.views import get_template, get_schema, get_types_for_parent
 from AssetStorm.assets.views import deliver_open_api_definition, live
-from AssetStorm.assets.views import update_caches, delete_all_assets
+from AssetStorm.assets.views import update_caches, job_status, delete_all_assets
 
 urlpatterns = [
     path('', turnout, name="turnout_request"),
     path('load', load_asset, name="load_asset"),
+    path('load_many', load_many_assets, name="load_many_assets"),
+    path('history', load_history, name="load_history"),
+    path('diff', diff_revisions, name="diff_revisions"),
     path('save', save_asset, name="save_asset"),
     path('find', query, {"query_string": ""}, name="filter_assets"),
     path('find/<str:query_string>', query, name="find_assets"),
@@ -29,6 +33,7 @@ urlpatterns = [
     path('get_schema', get_schema, name="get_schema"),
     path('get_types_for_parent', get_types_for_parent, name="get_types_for_parent"),
     path('update_caches', update_caches, name="update_caches"),
+    path('jobs/<str:job_id>', job_status, name="job_status"),
     path('openapi.json', deliver_open_api_definition, name="openapi.json"),
     path('live', live, name="live"),
     path('delete_all_assets', delete_all_assets, name="delete_all_assets")